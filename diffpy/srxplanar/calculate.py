@@ -14,6 +14,8 @@
 ##############################################################################
 
 import numpy as np
+import weakref
+from multiprocessing.pool import ThreadPool
 import scipy.sparse as ssp
 import scipy.ndimage.filters as snf
 import scipy.ndimage.morphology as snm
@@ -49,18 +51,48 @@ class Calculate(object):
     polcorrectf = _configPropertyR('polcorrectf')
     cropedges = _configPropertyR('cropedges')
     extracrop = _configPropertyR('extracrop')
+    splitpixel = _configPropertyR('splitpixel')
+    azimuthstep = _configPropertyR('azimuthstep')
+    sectornumber = _configPropertyR('sectornumber')
+    sectoroffset = _configPropertyR('sectoroffset')
+    nthreads = _configPropertyR('nthreads')
+    geometrydtype = _configPropertyR('geometrydtype')
+    leanmemory = _configPropertyR('leanmemory')
+    gainmode = _configPropertyR('gainmode')
+    gainsubsample = _configPropertyR('gainsubsample')
+    gainrecompute = _configPropertyR('gainrecompute')
+    gaindrift = _configPropertyR('gaindrift')
+    variancemodel = _configPropertyR('variancemodel')
 
 
-    def __init__(self, p):
+    # arrays needed in integration, see self.getState
+    _statenames = ['xr', 'yr', 'bin_edges', 'xgrid', 'staticinds', 'staticbins']
+
+    def __init__(self, p, prepare=True):
         # create parameter proxy, so that parameters can be accessed by self.parametername in read-only mode
         self.config = p
-        self.prepareCalculation()
+        self.pixelgain = None
+        self.pixelcorrection = None
+        self.threadpool = None
+        if prepare:
+            self.prepareCalculation()
         return
 
     def prepareCalculation(self):
         '''
         prepare data for calculation
         '''
+        self.prepareGeometry()
+        self.genTTHorQMatrix()
+        self._resetCache()
+        self.genIntegrationInds()
+        return
+
+    def prepareGeometry(self):
+        '''
+        prepare the pixel positions, they only depend on the detector geometry and self.cropedges.
+        The geometry matrices (distance, tth, q and azimuth) are calculated when they are used
+        '''
         self.xydimension = self.xdimension * self.ydimension
         self.xr = (np.arange(self.xdimension, dtype=float) - self.xbeamcenter + 0.5) * self.xpixelsize
         self.yr = (np.arange(self.ydimension, dtype=float) - self.ybeamcenter + 0.5) * self.ypixelsize
@@ -68,50 +100,339 @@ class Calculate(object):
         self.xr = self.xr[self.cropedges[0]:-self.cropedges[1]]
         self.yr = self.yr[self.cropedges[2]:-self.cropedges[3]]
         
-        self.dmatrix = self.genDistanceMatrix()
-        self.azimuthmatrix = np.arctan2(self.yr.reshape(len(self.yr), 1),
-                                        self.xr.reshape(1, len(self.xr)))
-        self.genTTHorQMatrix()
-        self.perviousmaskedmatrix = np.zeros(4)
+        self.geometry = {}
+        self.azimuthinds = {}
+        self.tthorqinds = None
+        return
+
+    def dropIntermediates(self):
+        '''
+        release the arrays only used in preparing the integration state, i.e. the geometry 
+        matrices, the bin index of each pixel and the azimuthal bin index of each pixel. 
+        They are recalculated if needed (e.g. the static mask is changed).
+        '''
+        self.geometry = {}
+        self.azimuthinds = {}
+        self.tthorqinds = None
+        return
+
+    # dtype of the pixel and bin index arrays
+    indexdtype = property(lambda self: np.int32 if self.leanmemory else np.int_,
+                          doc='dtype of index arrays, int32 in lean memory mode')
+
+    def _resetCache(self):
+        '''
+        clear all cached data, called when the geometry is changed
+        '''
+        self.azimuthinds = {}
+        self.maskversion = 0
+        self.integrationmatrix = None
+        self.integrationmatrixversion = -1
+        self.resetGain()
+        return
+
+    def resetGain(self):
+        '''
+        clear the gain reused across images (see self.getGain), called when the 
+        geometry or the correction is changed
+        '''
+        self.gain = None
+        self.gainframes = 0
+        self.gaintotal = None
+        self.framepic = None
+        self.framegain = None
+        self.framecorrected = False
+        return
+
+    def newFrame(self, pic, corrected=False):
+        '''
+        start processing a new image, the gain of this image is estimated (or reused, see 
+        self.getGain) only once in the following calls with the same image, until next 
+        call of this method. The image should not be changed in between.
+        
+        :param pic: 2d array, image (full image)
+        :param corrected: bool, True if the correction is applied to the image, used in 
+            the poisson and gainmap variance model (see self.setPixelGain)
+        '''
+        self.framepic = weakref.ref(pic)
+        self.framegain = None
+        self.framecorrected = corrected
+        return
+
+    def setPixelGain(self, pixelgain=None, correction=None):
+        '''
+        set the gain of each pixel used in the poisson and gainmap variance model (see 
+        self.variancemodel), the variance of raw counts of a pixel is (gain * raw counts). 
+        If the correction is applied to the image (see self.newFrame), the variance of 
+        corrected counts is (correction * gain * corrected counts).
+        
+        :param pixelgain: 2d array or None, gain of each pixel in the image cropped by 
+            self.cropedges, None for gain 1 of all pixels (poisson)
+        :param correction: 2d array or None, correction matrix, see self.genCorrectionMatrix
+        '''
+        self.pixelgain = pixelgain
+        self.pixelcorrection = correction
+        self.activegain = {}
+        return
+
+    def getState(self):
+        '''
+        return the prepared arrays needed in integration (bin index of each pixel, unmasked 
+        pixels, pixel splitting matrix, etc.), they could be saved to disk and used to restore 
+        another instance by self.setState without the prepare calculation. The azimuth matrix is 
+        included if it is already calculated, the distance, tth and q matrix are not included.
+        The bin index of each pixel is included if it is not dropped (see self.dropIntermediates).
+        
+        :return: dict, name and array, the pixel splitting matrix is stored as its 
+            data, indices and indptr arrays
+        '''
+        rv = dict([(name, getattr(self, name)) for name in self._statenames])
+        if self.tthorqinds is not None:
+            rv['tthorqinds'] = self.tthorqinds
+        if self.geometry.has_key('azimuthmatrix'):
+            rv['azimuthmatrix'] = self.geometry['azimuthmatrix']
+        if self.splitmatrix is not None:
+            rv['splitdata'] = self.splitmatrix.data
+            rv['splitindices'] = self.splitmatrix.indices
+            rv['splitindptr'] = self.splitmatrix.indptr
+        return rv
+
+    def setState(self, state):
+        '''
+        restore the prepared arrays returned by self.getState, the arrays are used directly 
+        (not copied) and are not modified, so read-only memory-mapped arrays can be used. 
+        The state should be generated with the same configuration. The geometry matrices 
+        not included in state are recalculated when they are used.
+        
+        :param state: dict, name and array, returned by self.getState
+        '''
+        self.xydimension = self.xdimension * self.ydimension
+        for name in self._statenames:
+            setattr(self, name, state[name])
+        self.tthorqinds = state.get('tthorqinds')
+        self.geometry = {}
+        if state.has_key('azimuthmatrix'):
+            self.geometry['azimuthmatrix'] = state['azimuthmatrix']
+        self.nbins = len(self.bin_edges) - 1
+        if state.has_key('splitdata'):
+            self.splitmatrix = ssp.csc_matrix((state['splitdata'], state['splitindices'], state['splitindptr']),
+                                              shape=(self.nbins, len(self.xr) * len(self.yr)))
+        else:
+            self.splitmatrix = None
+        self._resetCache()
+        self._resetActive()
+        return
+
+    def _maskChanged(self):
+        '''
+        clear the cached data depending on the active pixels, called when the static mask 
+        or the crop is changed
+        '''
+        self.maskversion += 1
+        self.cakeinds = {}
+        self.activegain = {}
+        self.threadchunks = None
         return
 
     def genTTHorQMatrix(self):
         '''
-        generate a twotheta matrix or q matrix which stores the tth or q value
-        or each pixel
+        generate the tth or q grid and the bin index of each pixel (and the pixel 
+        splitting matrix) according to the tth or q value of each pixel
         '''
+        # q matrix depends on wavelength, which is not a geometry option
+        self.geometry.pop('qmatrix', None)
         # set tth or q grid
         if self.integrationspace == 'twotheta':
             self.bin_edges = np.r_[0, np.arange(self.tthstep / 2, self.tthmax, self.tthstep)]
             self.xgrid = np.degrees(self.bin_edges[1:] - self.tthstep / 2)
-            self.tthorqmatrix = self.genTTHMatrix()
         elif self.integrationspace == 'qspace':
             self.bin_edges = np.r_[0, np.arange(self.qstep / 2, self.qmax, self.qstep)]
             self.xgrid = self.bin_edges[1:] - self.qstep / 2
-            self.tthorqmatrix = self.genQMatrix()
+        self.nbins = len(self.bin_edges) - 1
+        self.tthorqinds = self.genBinInds(self.tthorqmatrix)
+        self.splitmatrix = self.genSplitMatrix() if self.splitpixel == 'bbox' else None
         return
 
+    def genBinInds(self, tthorqmatrix):
+        '''
+        generate the bin index of each pixel, the binning follows np.histogram, i.e.
+        bin i covers [bin_edges[i], bin_edges[i+1]) and the last bin also includes
+        its right edge. Pixels out of the range are put into an extra bin (self.nbins)
+        which is discarded in integration.
+        
+        :param tthorqmatrix: 2d array, tth or q value of each pixel
+        
+        :return: 2d int array, bin index of each pixel
+        '''
+        inds = np.searchsorted(self.bin_edges, tthorqmatrix, side='right') - 1
+        inds[tthorqmatrix == self.bin_edges[-1]] = self.nbins - 1
+        inds[np.logical_or(inds < 0, inds >= self.nbins)] = self.nbins
+        return inds.astype(self.indexdtype, copy=False)
+
+    def genSplitMatrix(self):
+        '''
+        generate the pixel splitting matrix. The tth or q range of each pixel is 
+        approximated by the range of its four corners (bounding box), and the pixel 
+        is split uniformly over the bins covered by this range.
+        
+        :return: scipy.sparse.csc_matrix, shape is (number of bins, number of pixels in 
+            cropped image), fraction of each pixel in each bin
+        '''
+        xe = np.r_[self.xr - self.xpixelsize / 2, self.xr[-1] + self.xpixelsize / 2]
+        ye = np.r_[self.yr - self.ypixelsize / 2, self.yr[-1] + self.ypixelsize / 2]
+        corners = self._tthMatrix(xe, ye)
+        if self.integrationspace == 'qspace':
+            corners = self._tth2Q(corners)
+        cs = [corners[:-1, :-1], corners[1:, :-1], corners[:-1, 1:], corners[1:, 1:]]
+        lo = np.minimum(np.minimum(cs[0], cs[1]), np.minimum(cs[2], cs[3])).ravel()
+        hi = np.maximum(np.maximum(cs[0], cs[1]), np.maximum(cs[2], cs[3])).ravel()
+        width = hi - lo
+        
+        edges = self.bin_edges
+        ilo = np.maximum(np.searchsorted(edges, lo, side='right') - 1, 0)
+        ihi = np.minimum(np.searchsorted(edges, hi, side='right') - 1, self.nbins - 1)
+        span = ihi - ilo + 1
+        pixels = np.arange(len(lo))
+        rows = []
+        cols = []
+        data = []
+        for k in range(max(span.max(), 0)):
+            sel = span > k
+            b = ilo[sel] + k
+            overlap = np.minimum(hi[sel], edges[b + 1]) - np.maximum(lo[sel], edges[b])
+            w = width[sel]
+            frac = np.where(w > 0, overlap / np.where(w > 0, w, 1), 1.0)
+            keep = frac > 0
+            rows.append(b[keep])
+            cols.append(pixels[sel][keep])
+            data.append(frac[keep])
+        rv = ssp.csc_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                            shape=(self.nbins, len(lo)))
+        return rv
+
     def genIntegrationInds(self, mask=None):
         '''
-        generate self.bin_number used in integration (number of pixels in on bin)
+        generate the compact integration state, i.e. the flat index (self.staticinds) and 
+        the bin index (self.staticbins) of unmasked pixels in the image cropped by self.cropedges. 
+        Mask here is treated as static mask, mask changed for each image should be set 
+        using self.setDynamicMask
         
         :param mask: 2D array, mask of image, should have same dimension, 1 for masked pixel
         
         :return: self.bin_number
         '''
-        self.maskedmatrix = np.array(self.tthorqmatrix)
-        if mask == None:
-            # mask = np.zeros((self.ydimension, self.xdimension), dtype=bool)
-            mask = np.zeros((len(self.yr), len(self.xr)), dtype=bool)
+        # release the previous state before generating the new one
+        self.staticinds = self.staticbins = self.activeinds = self.activemap = None
+        if self.tthorqinds is None:
+            # dropped by self.dropIntermediates
+            self.tthorqinds = self.genBinInds(self.tthorqmatrix)
         ce = self.cropedges
-        mask = mask[ce[2]:-ce[3], ce[0]:-ce[1]]
-        self.maskedmatrix[mask] = 1000.0
+        unmasked = self.tthorqinds < self.nbins
+        if mask is not None:
+            unmasked = np.logical_and(unmasked, np.logical_not(mask[ce[2]:-ce[3], ce[0]:-ce[1]]))
+        self.staticinds = np.flatnonzero(unmasked).astype(self.indexdtype, copy=False)
+        del unmasked
+        self.staticbins = self.tthorqinds.ravel()[self.staticinds]
+        self._resetActive()
+        return self.bin_number
+
+    def _resetActive(self):
+        '''
+        clear the dynamic mask and regenerate the active pixels, called when the static 
+        integration state is changed
+        '''
+        self.dynamicmaskinds = np.zeros(0, dtype=int)
+        self.activecrop = None
+        self.getActiveInds()
+        return
+
+    def setDynamicMask(self, mask=None):
+        '''
+        set the mask which changes for each image (dynamic mask). Only the masked pixels
+        are processed, pixels already masked in static mask are ignored. 
+        
+        :param mask: 2D array, dynamic mask of image, 1 for masked pixel, if None, 
+            clear the dynamic mask
+        
+        :return: self.bin_number
+        '''
+        self.dynamicmaskinds = np.zeros(0, dtype=int) if mask is None else np.flatnonzero(mask)
+        self.getActiveInds()
+        self._updateDynamic()
+        return self.bin_number
+
+    def getActiveInds(self):
+        '''
+        return the flat index (in full image) and the bin index of active pixels, i.e.
+        unmasked pixels in the image cropped by self.cropedges and self.extracrop (pixels 
+        in dynamic mask are included). They are regenerated only when the crop changes. 
         
-        # extra crop
-        maskedmatrix = self.getMaskedmatrixPic()
-        # self.bin_number = np.array(np.histogram(maskedmatrix, self.bin_edges)[0], dtype=float)
-        # self.bin_number[self.bin_number <= 0] = 1
-        return  # self.bin_number
+        :return: [activeinds, activebins], 1d int arrays
+        '''
+        crop = tuple([max(s1, s2) for s1, s2 in zip(self.cropedges, self.extracrop)])
+        if crop != self.activecrop:
+            self.activecrop = crop
+            ce = self.cropedges
+            ny, nx = len(self.yr), len(self.xr)
+            rows = self.staticinds // nx
+            if crop == tuple(ce):
+                # extracrop is inside cropedges, all static pixels are active
+                sel = slice(None)
+                self.activeinds = self.staticinds + rows * (self.xdimension - nx) + ce[2] * self.xdimension + ce[0]
+            else:
+                cols = self.staticinds % nx
+                sel = (rows >= crop[2] - ce[2]) & (rows < ny - crop[3] + ce[3]) & \
+                      (cols >= crop[0] - ce[0]) & (cols < nx - crop[1] + ce[1])
+                self.activeinds = (rows[sel] + ce[2]) * self.xdimension + cols[sel] + ce[0]
+            self.activebins = self.staticbins[sel]
+            self.activemap = np.empty(self.xydimension, dtype=self.indexdtype)
+            self.activemap.fill(-1)
+            self.activemap[self.activeinds] = np.arange(len(self.activeinds), dtype=self.indexdtype)
+            if self.splitmatrix is None:
+                self.cropcount = np.bincount(self.activebins, minlength=self.nbins).astype(float)
+            else:
+                self.activesplit = self.splitmatrix[:, self.staticinds[sel]]
+                self.cropcount = np.asarray(self.activesplit.sum(axis=1)).ravel()
+            self._maskChanged()
+            self._updateDynamic(reset=True)
+        return self.activeinds, self.activebins
+
+    def _updateDynamic(self, reset=False):
+        '''
+        locate the dynamic masked pixels in active pixels and update self.bin_number 
+        incrementally, i.e. only the pixels added to or removed from the dynamic mask 
+        are processed. self.maskversion is increased if the mask is changed.
+        
+        :param reset: bool, if True, rebuild the dynamic state (used when active pixels changed)
+        '''
+        pos = self.activemap[self.dynamicmaskinds]
+        pos = pos[pos >= 0]
+        if reset:
+            self.dynamicflag = np.zeros(len(self.activeinds), dtype=bool)
+            self.dynamicpos = np.zeros(0, dtype=int)
+            self.dynamiccount = np.zeros(self.nbins)
+            self.bin_number = np.array(self.cropcount)
+            self.bin_number[self.bin_number <= 0] = 1
+        added = pos[np.logical_not(self.dynamicflag[pos])]
+        self.dynamicflag[self.dynamicpos] = False
+        self.dynamicflag[pos] = True
+        removed = self.dynamicpos[np.logical_not(self.dynamicflag[self.dynamicpos])]
+        self.dynamicpos = pos
+        
+        if (len(added) > 0) or (len(removed) > 0):
+            if self.splitmatrix is None:
+                delta = np.bincount(self.activebins[added], minlength=self.nbins) - \
+                        np.bincount(self.activebins[removed], minlength=self.nbins)
+            else:
+                delta = np.asarray(self.activesplit[:, added].sum(axis=1)).ravel() - \
+                        np.asarray(self.activesplit[:, removed].sum(axis=1)).ravel()
+            affected = np.flatnonzero(delta)
+            self.dynamiccount[affected] += delta[affected]
+            count = self.cropcount[affected] - self.dynamiccount[affected]
+            count[count <= 0] = 1
+            self.bin_number[affected] = count
+            self.maskversion += 1
+        return
 
     def intensity(self, pic):
         '''
@@ -122,40 +443,471 @@ class Calculate(object):
         :retrun: 2d array, [tthorq, intensity, unceratinty] or [tthorq, intensity]
         '''
 
-        intensity = self.calculateIntensity(pic)
         if self.uncertaintyenable:
-            std = np.sqrt(self.calculateVariance(pic))
-            rv = np.vstack([self.xgrid, intensity, std])
+            intensity, variance = self.calculateIntensityVariance(pic)
+            rv = np.vstack([self.xgrid, intensity, np.sqrt(variance)])
         else:
+            intensity = self.calculateIntensity(pic)
             rv = np.vstack([self.xgrid, intensity])
         return rv
     
-    def getMaskedmatrixPic(self, pic=None):
+    def getCropPic(self, pic):
         '''
-        return the maskedmatrix and pic using self.extracrop and self.cropedges
+        crop the pic using self.extracrop and self.cropedges
         
-        :param pic: 2d array, pic array, if None, then only return maskedmatrix
+        :param pic: 2d array or 3d array, pic array or stack of pic arrays
         
-        :return: croped maskedmatrix and pic 
+        :return: croped pic 
         '''
-        ec = self.extracrop
-        ce = self.cropedges
-        s = [ecx - cex if ecx > cex else 0 for ecx, cex in zip(ec, ce)]
-        s[3] = -s[3] if s[3] != 0 else None
-        s[1] = -s[1] if s[1] != 0 else None
-        rv = self.maskedmatrix[s[2]:s[3], s[0]:s[1]]
-        
-        temps = np.array(s)
-        if any(self.perviousmaskedmatrix != temps):
-           self.perviousmaskedmatrix = temps
-           self.bin_number = np.array(np.histogram(rv, self.bin_edges)[0], dtype=float)
-           self.bin_number[self.bin_number <= 0] = 1
-        
-        if pic != None:
-            ps = [max(s1, s2) for s1, s2 in zip(ce, ec)]
-            rv = self.maskedmatrix[s[2]:s[3], s[0]:s[1]], pic[ps[2]:-ps[3], ps[0]:-ps[1]]
+        ps = [max(s1, s2) for s1, s2 in zip(self.cropedges, self.extracrop)]
+        return pic[..., ps[2]:-ps[3], ps[0]:-ps[1]]
+
+    def getIntegrationMatrix(self):
+        '''
+        return the sparse integration matrix which maps the raw counts of all pixels 
+        of a (flattened) image to the 1D intensity. Mask, self.cropedges, self.extracrop 
+        and the 1/self.bin_number normalization are included. The matrix is cached and 
+        only regenerated when self.maskversion changes.
+        
+        :return: scipy.sparse.csr_matrix, shape is (number of bins, number of pixels)
+        '''
+        activeinds, activebins = self.getActiveInds()
+        if self.integrationmatrixversion != self.maskversion:
+            weights = np.ones(len(activeinds))
+            weights[self.dynamicpos] = 0
+            if self.splitmatrix is None:
+                bininds = activebins
+                pixelinds = activeinds
+                data = weights / self.bin_number[bininds]
+            else:
+                m = (self.activesplit * ssp.diags(weights, 0)).tocoo()
+                bininds = m.row
+                pixelinds = activeinds[m.col]
+                data = m.data / self.bin_number[bininds]
+            m = ssp.csr_matrix((data, (bininds, pixelinds)), shape=(self.nbins, self.xydimension))
+            m.eliminate_zeros()
+            self.integrationmatrix = m
+            self.integrationmatrixversion = self.maskversion
+        return self.integrationmatrix
+
+    def calculateIntensityStack(self, pics):
+        '''
+        calculate the 1D intensity of a stack of images using the cached integration matrix
+        
+        :param pics: 3d array, stack of images (number of images, ydimension, xdimension), 
+            raw counts should be corrected, could be a np.memmap
+        
+        :return: 2d array, 1D integrated intensity of each image, shape is 
+            (number of images, number of bins)
+        '''
+        return self._stackDot(self.getIntegrationMatrix(), pics)
+
+    def _stackDot(self, matrix, pics, square=False):
+        '''
+        multiply the sparse matrix with each (flattened) image of the stack. Images are 
+        multiplied one by one as contiguous vectors, so no transposed copy of the stack is made
+        
+        :param matrix: scipy.sparse matrix, shape is (number of bins, number of pixels)
+        :param pics: 3d array, stack of images (number of images, ydimension, xdimension)
+        :param square: bool, if True, multiply the squares of pixel values, only one image 
+            is squared at a time
+        
+        :return: 2d array, shape is (number of images, number of bins)
+        '''
+        rv = np.empty((len(pics), matrix.shape[0]))
+        for i in range(len(pics)):
+            pic = pics[i].ravel()
+            if square:
+                pic = np.square(pic, dtype=float)
+            rv[i] = matrix.dot(pic)
+        return rv
+
+    def intensityStack(self, pics, corrected=False):
+        '''
+        integrate a stack of images, the variance of each pixel is estimated according to 
+        self.variancemodel. In local model, the gain of each image is estimated in the same 
+        way as self.calculateVarianceLocal, then the variance of integrated intensity 
+        is (gain * intensity) 
+        
+        :param pics: 3d array, stack of images (number of images, ydimension, xdimension),
+            corrections hould be already applied
+        :param corrected: bool, True if the correction is applied to the images, used in 
+            the poisson and gainmap variance model
+        
+        :return: [intensity, uncertainty], 2d arrays with shape (number of images, number of bins),
+            uncertainty is None if self.uncertaintyenable is False
+        '''
+        intensity = self.calculateIntensityStack(pics)
+        if not self.uncertaintyenable:
+            std = None
+        elif self.variancemodel == 'scatter':
+            # mean of squares of each bin
+            sumsq = self._stackDot(self.getIntegrationMatrix(), pics, square=True)
+            count = self.bin_number
+            std = np.sqrt(self._sampleVariance(intensity * count, sumsq * count, count))
+        elif self.variancemodel == 'local':
+            gain = self.estimateGain(self.getCropPic(pics))
+            std = np.sqrt(intensity * gain.reshape(len(gain), 1))
+        else:
+            gain = self.getActiveGain(corrected)
+            if gain is None:
+                std = np.sqrt(intensity)
+            else:
+                fullgain = np.zeros(self.xydimension)
+                fullgain[self.activeinds] = gain
+                varmatrix = self.getIntegrationMatrix().dot(ssp.diags(fullgain, 0))
+                std = np.sqrt(self._stackDot(varmatrix, pics))
+        return intensity, std
+
+    def genAzimuthInds(self, nazimuth, offset=0.0):
+        '''
+        generate the azimuthal bin index of each pixel, azimuth range [offset, offset + 2pi)
+        is divided into nazimuth equal bins. The result is cached.
+        
+        :param nazimuth: int, number of azimuthal bins
+        :param offset: float, start of the first azimuthal bin, in radians
+        
+        :return: 2d int array, azimuthal bin index of each pixel
+        '''
+        key = (nazimuth, offset)
+        if not self.azimuthinds.has_key(key):
+            self.azimuthinds[key] = self._azimuthBinInds(self.azimuthmatrix, nazimuth, offset)
+        return self.azimuthinds[key]
+
+    def _azimuthBinInds(self, azimuthmatrix, nazimuth, offset=0.0):
+        '''
+        divide azimuth range [offset, offset + 2pi) into nazimuth equal bins and 
+        return the bin index of each azimuthal angle
+        
+        :param azimuthmatrix: array, azimuthal angles, in radians
+        :param nazimuth: int, number of azimuthal bins
+        :param offset: float, start of the first azimuthal bin, in radians
+        
+        :return: int array, azimuthal bin index
+        '''
+        azimuth = np.mod(azimuthmatrix - offset, 2 * np.pi)
+        inds = (azimuth * (nazimuth / (2 * np.pi))).astype(self.indexdtype)
+        inds[inds >= nazimuth] = nazimuth - 1
+        return inds
+
+    def getCakeInds(self, nazimuth, offset=0.0):
+        '''
+        return the combined (azimuth, tth or q) bin index of active pixels, 
+        index = azimuth index * self.nbins + tth or q index. The result is cached
+        until the mask or crop changes.
+        
+        :param nazimuth: int, number of azimuthal bins
+        :param offset: float, start of the first azimuthal bin, in radians
+        
+        :return: 1d int array, combined bin index of each active pixel
+        '''
+        key = (nazimuth, offset)
+        activeinds, activebins = self.getActiveInds()
+        if not self.cakeinds.has_key(key):
+            ce = self.cropedges
+            rows = activeinds // self.xdimension - ce[2]
+            cols = activeinds % self.xdimension - ce[0]
+            if self.leanmemory:
+                # only the azimuth of active pixels is calculated, the azimuth matrix is not cached
+                dtype = self.geometrydtype
+                azimuth = np.arctan2(self.yr.astype(dtype)[rows], self.xr.astype(dtype)[cols])
+                azinds = self._azimuthBinInds(azimuth, nazimuth, offset)
+            else:
+                azinds = self.genAzimuthInds(nazimuth, offset)[rows, cols]
+            self.cakeinds[key] = azinds * self.nbins + activebins
+        return self.cakeinds[key]
+
+    def _cakeSum(self, pic, nazimuth, offset=0.0, weights=None):
+        '''
+        sum the values and count the active pixels (dynamic masked pixels excluded) in 
+        each (azimuth, tth or q) cell
+        
+        :param pic: 2d array, values of each pixel (full image)
+        :param nazimuth: int, number of azimuthal bins
+        :param offset: float, start of the first azimuthal bin, in radians
+        :param weights: 1d array or None, if provided, the values of active pixels are 
+            multiplied by weights before summed
+        
+        :return: [total, count], 2d arrays with shape (nazimuth, number of bins)
+        '''
+        cakeinds = self.getCakeInds(nazimuth, offset)
+        values = pic.ravel().take(self.activeinds)
+        values[self.dynamicpos] = 0
+        if weights is not None:
+            values = values * weights
+        size = nazimuth * self.nbins
+        total = np.bincount(cakeinds, weights=values, minlength=size)
+        count = np.bincount(cakeinds, minlength=size) - \
+                np.bincount(cakeinds[self.dynamicpos], minlength=size)
+        return total.reshape(nazimuth, self.nbins), count.reshape(nazimuth, self.nbins)
+
+    def cake(self, pic):
+        '''
+        2D caking integration, pixels are binned in (azimuth, tth or q) cells and then take 
+        average, azimuthal step is self.azimuthstep, pixel splitting is not applied. 
+        
+        :param pic: 2D array, array of raw counts, corrections hould be already applied
+        
+        :return: [cake, count, uncertainty], 2d arrays with shape (number of azimuthal bins, 
+            number of bins), cake is the averaged intensity, count is the number of pixels 
+            in each cell, uncertainty is None if self.uncertaintyenable is False
+        '''
+        nazimuth = int(np.ceil(2 * np.pi / self.azimuthstep - 1e-6))
+        self.azimuthgrid = np.degrees((np.arange(nazimuth) + 0.5) * 2 * np.pi / nazimuth)
+        total, count = self._cakeSum(pic, nazimuth)
+        cake = total / np.maximum(count, 1)
+        if self.uncertaintyenable:
+            std = np.sqrt(self._cakeVariance(pic, cake, np.maximum(count, 1), nazimuth))
+        else:
+            std = None
+        return cake, count, std
+
+    def sectorIntensity(self, pic):
+        '''
+        integrate the image into self.sectornumber azimuthal sectors at once, sectors start at
+        self.sectoroffset and have same width. Pixel splitting is not applied.
+        
+        :param pic: 2D array, array of raw counts, corrections hould be already applied
+        
+        :return: 3d array, shape is (number of sectors, 3, number of bins) as 
+            [tthorq, intensity, unceratinty] of each sector, or (number of sectors, 2, 
+            number of bins) as [tthorq, intensity] if self.uncertaintyenable is False
+        '''
+        nsector = self.sectornumber
+        total, count = self._cakeSum(pic, nsector, self.sectoroffset)
+        count = count.astype(float)
+        count[count <= 0] = 1
+        intensity = total / count
+        
+        xgrid = np.tile(self.xgrid, (nsector, 1))
+        if self.uncertaintyenable:
+            std = np.sqrt(self._cakeVariance(pic, intensity, count, nsector, self.sectoroffset))
+            rv = np.concatenate([xgrid[:, np.newaxis], intensity[:, np.newaxis], std[:, np.newaxis]], axis=1)
+        else:
+            rv = np.concatenate([xgrid[:, np.newaxis], intensity[:, np.newaxis]], axis=1)
+        return rv
+
+    def _cakeVariance(self, pic, intensity, count, nazimuth, offset=0.0):
+        '''
+        calculate the variance of averaged intensity in each (azimuth, tth or q) cell 
+        according to self.variancemodel
+        
+        :param pic: 2d array, array of raw counts, corrections hould be already applied
+        :param intensity: 2d array, averaged intensity in each cell
+        :param count: 2d array, number of pixels in each cell (>0)
+        :param nazimuth: int, number of azimuthal bins
+        :param offset: float, start of the first azimuthal bin, in radians
+        
+        :return: 2d array, variance in each cell
+        '''
+        if self.variancemodel == 'local':
+            return intensity * self.getGain(pic)
+        if self.variancemodel == 'scatter':
+            sumsq = self._cakeSum(pic, nazimuth, offset, pic.ravel().take(self.activeinds).astype(float))[0]
+            return self._sampleVariance(intensity * count, sumsq, count)
+        gain = self.getActiveGain(self._isCorrected(pic))
+        if gain is None:
+            return intensity
+        return self._cakeSum(pic, nazimuth, offset, gain)[0] / count
+
+    def _gatherActive(self, pic):
+        '''
+        gather the values of active pixels, values of dynamic masked pixels are set to 0
+        
+        :param pic: 2d array, values of each pixel (full image)
+        
+        :return: 1d array, values of active pixels
+        '''
+        activeinds, activebins = self.getActiveInds()
+        values = pic.ravel().take(activeinds)
+        values[self.dynamicpos] = 0
+        return values
+
+    def _reduceBins(self, values):
+        '''
+        sum the gathered values of active pixels in each bin, in pixel splitting mode, 
+        values are split into bins using self.activesplit
+        
+        :param values: 1d array, values of active pixels, returned by self._gatherActive
+        
+        :return: 1d array, sum of values in each bin
+        '''
+        if self.splitmatrix is None:
+            rv = np.bincount(self.activebins, weights=values, minlength=self.nbins)
+        else:
+            rv = self.activesplit.dot(values)
         return rv
+
+    def _binSum(self, pic):
+        '''
+        sum the values of active pixels (dynamic masked pixels excluded) in each bin
+        
+        :param pic: 2d array, values of each pixel (full image)
+        
+        :return: 1d array, sum of values in each bin
+        '''
+        if self.nthreads > 1:
+            return self._binSumThreaded(pic)
+        return self._reduceBins(self._gatherActive(pic))
+
+    def _genThreadChunks(self):
+        '''
+        split the active pixels into self.nthreads chunks of consecutive pixels (rows of image). 
+        Pixels in each chunk are sorted by their bin so that each chunk can be reduced 
+        by np.add.reduceat, which release the GIL. In pixel splitting mode, each chunk holds 
+        the columns of self.activesplit of its pixels.
+        '''
+        nthreads = self.nthreads
+        n = len(self.activeinds)
+        bounds = np.linspace(0, n, nthreads + 1).astype(int)
+        order = []
+        self.threadchunks = []
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            if self.splitmatrix is None:
+                o = lo + np.argsort(self.activebins[lo:hi], kind='mergesort')
+                bins = self.activebins[o]
+                starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]]) if hi > lo else np.zeros(0, dtype=int)
+                self.threadchunks.append((lo, hi, starts, bins[starts]))
+                order.append(o)
+            else:
+                self.threadchunks.append((lo, hi, self.activesplit[:, lo:hi], None))
+        if self.splitmatrix is None:
+            order = np.concatenate(order)
+            self.threadinds = self.activeinds[order]
+            self.threadpos = np.empty(n, dtype=self.indexdtype)
+            self.threadpos[order] = np.arange(n)
+        else:
+            self.threadinds = self.activeinds
+            self.threadpos = np.arange(n, dtype=self.indexdtype)
+        self.threadnumber = nthreads
+        self.threaddynamicversion = -1
+        if (self.threadpool is None) or (self.threadpoolsize != nthreads):
+            self.closeThreadPool()
+            self.threadpool = ThreadPool(nthreads)
+            self.threadpoolsize = nthreads
+        return
+
+    def closeThreadPool(self):
+        '''
+        terminate the worker threads used in multi-threaded integration, a new pool 
+        is created when it is needed again
+        '''
+        if self.threadpool is not None:
+            self.threadpool.terminate()
+            self.threadpool.join()
+            self.threadpool = None
+        return
+
+    def _binSumThreaded(self, pic):
+        '''
+        multi-threaded version of self._binSum, each thread gathers the values of one chunk 
+        of active pixels and reduces them into its own partial per-bin sum, the partial 
+        sums are accumulated in float64 (same as np.bincount) and merged at the end
+        
+        :param pic: 2d array, values of each pixel (full image)
+        
+        :return: 1d array, sum of values in each bin
+        '''
+        self.getActiveInds()
+        if (self.threadchunks is None) or (self.threadnumber != self.nthreads):
+            self._genThreadChunks()
+        if self.threaddynamicversion != self.maskversion:
+            self.threaddynamic = np.sort(self.threadpos[self.dynamicpos])
+            self.threaddynamicversion = self.maskversion
+        flat = pic.ravel()
+        values = np.empty(len(self.threadinds), dtype=flat.dtype)
+        dynamic = self.threaddynamic
+        nbins = self.nbins
+        
+        def reduceChunk(chunk):
+            lo, hi, starts, bins = chunk
+            v = values[lo:hi]
+            np.take(flat, self.threadinds[lo:hi], out=v, mode='clip')
+            v[dynamic[np.searchsorted(dynamic, lo):np.searchsorted(dynamic, hi)] - lo] = 0
+            if bins is None:
+                # pixel splitting, starts is the columns of splitting matrix of this chunk
+                return starts.dot(v)
+            partial = np.zeros(nbins)
+            if hi > lo:
+                partial[bins] = np.add.reduceat(v, starts, dtype=float)
+            return partial
+        
+        partials = self.threadpool.map(reduceChunk, self.threadchunks)
+        return np.sum(partials, axis=0)
+
+    def calculateIntensityVariance(self, pic):
+        '''
+        calculate the 1D intensity and its variance. The variance of each pixel is 
+        (gain * raw counts), in local model (see self.variancemodel), the gain is estimated 
+        from the image (see self.calculateVarianceLocal), so the binned variance is 
+        (gain * binned raw counts) and the active pixels are gathered and reduced only once. 
+        In poisson and gainmap model, the gain of each pixel is set by self.setPixelGain, the 
+        binned variance is the binned (gain * raw counts), which is the intensity itself if 
+        the gain of all pixels is 1, the active pixels are gathered once for both of them.
+        
+        In scatter model, the variance is the sample variance of pixel values in each bin, see 
+        self.calculateIntensityScatter.
+        
+        :param pic: 2D array, array of raw counts, corrections hould be already applied
+        
+        :return: [intensity, variance], 1d arrays
+        '''
+        if self.variancemodel == 'scatter':
+            intensity, scatter, sem = self.calculateIntensityScatter(pic)
+            return intensity, scatter ** 2
+        gain = None if self.variancemodel == 'local' else self.getActiveGain(self._isCorrected(pic))
+        if (gain is None) or (self.nthreads > 1):
+            total = self._binSum(pic)
+            values = None
+        else:
+            # gather once for both intensity and variance
+            values = self._gatherActive(pic)
+            total = self._reduceBins(values)
+        intensity = total / self.bin_number
+        if self.variancemodel == 'local':
+            return intensity, intensity * self.getGain(pic)
+        if gain is None:
+            return intensity, np.array(intensity)
+        values = self._gatherActive(pic) if values is None else values
+        # not in place, pic could be an integer array
+        values = values * gain
+        return intensity, self._reduceBins(values) / self.bin_number
     
+    def calculateIntensityScatter(self, pic):
+        '''
+        calculate the 1D intensity, the scatter (standard deviation) of pixel values in each 
+        bin and the standard error of the mean in one pass, the sum, sum of squares and number 
+        of active pixels of each bin are reduced from the values gathered once. The scatter 
+        is the azimuthal scatter of intensity, (scatter ** 2 / intensity) is close to the gain 
+        for a smooth powder ring and much larger for a spotty ring.
+        
+        :param pic: 2D array, array of raw counts, corrections hould be already applied
+        
+        :return: [intensity, scatter, sem], 1d arrays
+        '''
+        values = self._gatherActive(pic)
+        total = self._reduceBins(values)
+        # squared in float64, pic could be an integer array
+        sumsq = self._reduceBins(np.square(values, dtype=float))
+        count = self.bin_number
+        scatter = np.sqrt(self._sampleVariance(total, sumsq, count))
+        return total / count, scatter, scatter / np.sqrt(count)
+
+    def _sampleVariance(self, total, sumsq, count):
+        '''
+        calculate the sample variance from the sum, sum of squares and number of values, 
+        the variance is 0 if there are less than 2 values
+        
+        :param total: array, sum of values
+        :param sumsq: array, sum of squares of values
+        :param count: array, number of values (>0)
+        
+        :return: array, sample variance
+        '''
+        dof = count - 1.0
+        variance = np.maximum(sumsq - total * total / count, 0)
+        return np.where(dof > 0, variance / np.where(dof > 0, dof, 1), 0)
+
     def calculateIntensity(self, pic):
         '''
         calculate the 1D intensity
@@ -164,10 +916,7 @@ class Calculate(object):
         
         :retrun: 1d array, 1D integrated intensity
         '''
-        
-        maskedmatrix, pic = self.getMaskedmatrixPic(pic)
-        
-        intensity = np.histogram(maskedmatrix, self.bin_edges, weights=pic)[0]
+        intensity = self._binSum(pic)
         return intensity / self.bin_number
 
     def calculateVariance(self, pic):
@@ -178,11 +927,7 @@ class Calculate(object):
         
         :retrun: 1d array, variance of integrated intensity
         '''
-        maskedmatrix = self.getMaskedmatrixPic()
-        
-        picvar = self.calculateVarianceLocal(pic)
-        variance = np.histogram(maskedmatrix, self.bin_edges, weights=picvar)[0]
-        return variance / self.bin_number
+        return self.calculateIntensityVariance(pic)[1]
 
     def calculateVarianceLocal(self, pic):
         '''
@@ -191,26 +936,147 @@ class Calculate(object):
         
         :param pic: 2d array, 2d image array, corrections hould be already applied
         
-        :return: 2d array, variance of each pixel
+        :return: 2d array, variance of each pixel in the image cropped by self.cropedges 
+            and self.extracrop (see self.getCropPic)
+        '''
+        var = self.getCropPic(pic) * self.getGain(pic)
+        return var
+
+    def _isCorrected(self, pic):
+        '''
+        return True if the correction is applied to the image, see self.newFrame
+        '''
+        return (self.framepic is not None) and (self.framepic() is pic) and self.framecorrected
+
+    def getActiveGain(self, corrected=False):
         '''
-        maskedmatrix, pic = self.getMaskedmatrixPic(pic)
+        return the gain of active pixels used in the poisson and gainmap variance model, 
+        see self.setPixelGain. The result is cached until the crop changes.
         
-        picavg = snf.uniform_filter(pic, 5, mode='wrap')
+        :param corrected: bool, True if the correction is applied to the image
+        
+        :return: 1d array or None, gain of each active pixel, None if the gain of all pixels is 1
+        '''
+        factors = [self.pixelgain]
+        if corrected:
+            factors.append(self.pixelcorrection)
+        factors = [f for f in factors if f is not None]
+        if len(factors) == 0:
+            return None
+        self.getActiveInds()
+        if not self.activegain.has_key(corrected):
+            ce = self.cropedges
+            nx = len(self.xr)
+            cropinds = (self.activeinds // self.xdimension - ce[2]) * nx + self.activeinds % self.xdimension - ce[0]
+            gain = factors[0].ravel().take(cropinds)
+            for f in factors[1:]:
+                gain *= f.ravel().take(cropinds)
+            self.activegain[corrected] = gain
+        return self.activegain[corrected]
+
+    def getGain(self, pic):
+        '''
+        return the gain of image used in uncertainty propagation. The gain is estimated by 
+        self.estimateGain and reused for the following images, it is estimated again every 
+        self.gainrecompute images, or when the total counts drift more than self.gaindrift 
+        (relative) from those of the image used in last estimation. Each call is counted as 
+        one image, except the repeated calls with the image set by self.newFrame (e.g. 
+        intensity and sector intensity of same image), which return same gain.
+        
+        :param pic: 2d array, image (full image), corrections hould be already applied
+        
+        :return: float, gain of image
+        '''
+        sameframe = (self.framepic is not None) and (self.framepic() is pic)
+        if sameframe and (self.framegain is not None):
+            return self.framegain
+        croppic = self.getCropPic(pic)
+        self.gainframes += 1
+        total = croppic.sum() if self.gaindrift > 0 else None
+        if (self.gain is None) or \
+                ((self.gainrecompute > 0) and (self.gainframes >= self.gainrecompute)) or \
+                ((total is not None) and (self.gaintotal is not None) and
+                 (abs(total - self.gaintotal) > self.gaindrift * abs(self.gaintotal))):
+            self.gain = self.estimateGain(croppic)
+            self.gainframes = 0
+            self.gaintotal = total
+        if sameframe:
+            self.framegain = self.gain
+        return self.gain
+
+    def estimateGain(self, pic):
+        '''
+        estimate the gain of image(s) according to self.gainmode, see self.calculateGain 
+        and self.calculateGainSubsample
+        
+        :param pic: 2d array or 3d array, croped image or stack of croped images, 
+            corrections hould be already applied
+        
+        :return: float or 1d array, median of gain of the image or of each image in stack
+        '''
+        if self.gainmode == 'subsample':
+            return self.calculateGainSubsample(pic, self.gainsubsample)
+        return self.calculateGain(pic)
+
+    def calculateGain(self, pic):
+        '''
+        estimate the gain (ratio between local variance and raw counts) of image(s)
+        
+        :param pic: 2d array or 3d array, croped image or stack of croped images, 
+            corrections hould be already applied
+        
+        :return: float or 1d array, median of gain of the image or of each image in stack
+        '''
+        size = 5 if pic.ndim == 2 else (1, 5, 5)
+        picavg = snf.uniform_filter(pic, size, mode='wrap')
         pics2 = (pic - picavg) ** 2
-        pvar = snf.uniform_filter(pics2, 5, mode='wrap')
+        pvar = snf.uniform_filter(pics2, size, mode='wrap')
+        return self._gainMedian(pvar / pic)
 
-        gain = pvar / pic
+    def calculateGainSubsample(self, pic, step):
+        '''
+        estimate the gain in the same way as self.calculateGain, but only the gain of pixels 
+        in every step-th row is calculated. Only the 9 rows around each sampled row are 
+        filtered, so the cost is about 9 / step of self.calculateGain.
+        
+        :param pic: 2d array or 3d array, croped image or stack of croped images, 
+            corrections hould be already applied
+        :param step: int, step of sampled rows
+        
+        :return: float or 1d array, median of gain of the image or of each image in stack
+        '''
+        ny = pic.shape[-2]
+        rows = np.arange(min(step, ny) // 2, ny, max(step, 1))
+        # rows (row - 4 ... row + 4) of each sampled row, wrapped as in self.calculateGain
+        strip = pic[..., np.mod(rows.reshape(len(rows), 1) + np.arange(-4, 5), ny), :]
+        picavg = snf.uniform_filter1d(strip, 5, axis=-1, mode='wrap')
+        picavg = snf.uniform_filter1d(picavg, 5, axis=-2)[..., 2:7, :]
+        pics2 = (strip[..., 2:7, :] - picavg) ** 2
+        pvar = snf.uniform_filter1d(pics2, 5, axis=-1, mode='wrap').mean(axis=-2)
+        return self._gainMedian(pvar / strip[..., 4, :])
+
+    def _gainMedian(self, gain):
+        '''
+        median of the gain of each pixel
+        
+        :param gain: 2d array or 3d array, gain of pixels of an image or a stack of images
+        
+        :return: float or 1d array, median of gain of the image or of each image in stack
+        '''
         inds = np.nonzero(np.logical_and(np.isnan(gain), np.isinf(gain)))
         gain[inds] = 0
-        gainmedian = np.median(gain, overwrite_input=True)
-        var = pic * gainmedian
-        return var
+        if gain.ndim == 2:
+            gainmedian = np.median(gain, overwrite_input=True)
+        else:
+            gainmedian = np.median(gain.reshape(len(gain), gain[0].size), axis=1, overwrite_input=True)
+        return gainmedian
 
-    def genDistanceMatrix(self):
+    def _getSource(self):
         '''
-        Calculate the distance matrix
+        get the position of source relative to the beam center in the detector plane 
+        coordinates, shared by all geometry matrices
         
-        :return: 2d array, distance between source and each pixel
+        :return: [sourcexr, sourceyr, sourcezr]
         '''
         sinr = np.sin(-self.rotation)
         cosr = np.cos(-self.rotation)
@@ -219,71 +1085,126 @@ class Calculate(object):
         sourcexr = -self.distance * sint * cosr
         sourceyr = self.distance * sint * sinr
         sourcezr = self.distance * cost
+        return sourcexr, sourceyr, sourcezr
 
-        # dmatrix = np.zeros((self.ydimension, self.xdimension), dtype=float)
-        dmatrix = np.zeros((len(self.yr), len(self.xr)), dtype=float)
-        dmatrix += ((self.xr - sourcexr) ** 2).reshape(1, len(self.xr))
-        dmatrix += ((self.yr - sourceyr) ** 2).reshape(len(self.yr), 1)
+    def _distanceMatrix(self, xr, yr, dtype=float):
+        '''
+        Calculate the distance between source and a grid of detector positions
+        
+        :param xr: 1d array, x positions on detector (relative to beam center)
+        :param yr: 1d array, y positions on detector (relative to beam center)
+        :param dtype: dtype of returned array
+        
+        :return: 2d array, distance between source and each position
+        '''
+        sourcexr, sourceyr, sourcezr = self._getSource()
+        dmatrix = np.empty((len(yr), len(xr)), dtype=dtype)
+        np.add(((xr - sourcexr) ** 2).reshape(1, len(xr)),
+               ((yr - sourceyr) ** 2).reshape(len(yr), 1), out=dmatrix)
         dmatrix += sourcezr ** 2
-        self.dmatrix = np.sqrt(dmatrix)
-        return self.dmatrix
+        np.sqrt(dmatrix, out=dmatrix)
+        return dmatrix
 
-    def genTTHMatrix(self):
+    def _tthMatrix(self, xr, yr, dmatrix=None, dtype=float):
         '''
-        Calculate the diffraction angle matrix 
+        Calculate the diffraction angle on a grid of detector positions 
         
-        :return: 2d array, two theta angle (in radians) of each pixel's center
+        :param xr: 1d array, x positions on detector (relative to beam center)
+        :param yr: 1d array, y positions on detector (relative to beam center)
+        :param dmatrix: 2d array, distance matrix of these positions, calculated if None
+        :param dtype: dtype of returned array
+        
+        :return: 2d array, two theta angle (in radians) of each position
         '''
+        sourcexr, sourceyr, sourcezr = self._getSource()
+        dmatrix = self._distanceMatrix(xr, yr, dtype) if dmatrix is None else dmatrix
+        tthmatrix = np.empty((len(yr), len(xr)), dtype=dtype)
+        np.add(((-xr + sourcexr) * sourcexr).reshape(1, len(xr)),
+               ((-yr + sourceyr) * sourceyr).reshape(len(yr), 1), out=tthmatrix)
+        tthmatrix += sourcezr * sourcezr
+        tthmatrix /= dmatrix
+        tthmatrix /= self.distance
+        np.arccos(tthmatrix, out=tthmatrix)
+        return tthmatrix
 
-        sinr = np.sin(-self.rotation)
-        cosr = np.cos(-self.rotation)
-        sint = np.sin(self.tilt)
-        cost = np.cos(self.tilt)
-        sourcexr = -self.distance * sint * cosr
-        sourceyr = self.distance * sint * sinr
-        sourcezr = self.distance * cost
-
-        # tthmatrix1 = np.zeros((self.ydimension, self.xdimension), dtype=float)
-        tthmatrix1 = np.zeros((len(self.yr), len(self.xr)), dtype=float)
-        tthmatrix1 += ((-self.xr + sourcexr) * sourcexr).reshape(1, len(self.xr))
-        tthmatrix1 += ((-self.yr + sourceyr) * sourceyr).reshape(len(self.yr), 1)
-        tthmatrix1 += sourcezr * sourcezr
-        tthmatrix = np.arccos(tthmatrix1 / self.dmatrix / self.distance)
-        self.tthmatrix = tthmatrix
+    def _tth2Q(self, tthmatrix):
+        '''
+        convert the two theta angle to q in place
+        
+        :param tthmatrix: array, two theta angle (in radians), overwritten by q
+        
+        :return: array, q value
+        '''
+        tthmatrix /= 2.0
+        np.sin(tthmatrix, out=tthmatrix)
+        tthmatrix *= 4 * np.pi
+        tthmatrix /= self.wavelength
         return tthmatrix
 
+    def _getGeometry(self, name, func):
+        '''
+        return the geometry matrix from cache, calculate it using func if not cached
+        '''
+        if not self.geometry.has_key(name):
+            self.geometry[name] = func()
+        return self.geometry[name]
+
+    def genDistanceMatrix(self):
+        '''
+        Calculate the distance matrix, the result is cached
+        
+        :return: 2d array, distance between source and each pixel
+        '''
+        return self._getGeometry('dmatrix',
+                    lambda: self._distanceMatrix(self.xr, self.yr, self.geometrydtype))
+
+    def genTTHMatrix(self):
+        '''
+        Calculate the diffraction angle matrix, the result is cached
+        
+        :return: 2d array, two theta angle (in radians) of each pixel's center
+        '''
+        return self._getGeometry('tthmatrix',
+                    lambda: self._tthMatrix(self.xr, self.yr, self.genDistanceMatrix(), self.geometrydtype))
+
     def genQMatrix(self):
         '''
-        Calculate the q matrix 
+        Calculate the q matrix, the result is cached
         
         :return: 2d array, q value of each pixel's center
         '''
-        sinr = np.sin(-self.rotation)
-        cosr = np.cos(-self.rotation)
-        sint = np.sin(self.tilt)
-        cost = np.cos(self.tilt)
-        sourcexr = -self.distance * sint * cosr
-        sourceyr = self.distance * sint * sinr
-        sourcezr = self.distance * cost
+        return self._getGeometry('qmatrix', lambda: self._tth2Q(np.array(self.genTTHMatrix())))
+
+    def genAzimuthMatrix(self):
+        '''
+        Calculate the azimuth matrix, the result is cached
+        
+        :return: 2d array, azimuthal angle (in radians) of each pixel's center
+        '''
+        dtype = self.geometrydtype
+        return self._getGeometry('azimuthmatrix',
+                    lambda: np.arctan2(self.yr.astype(dtype).reshape(len(self.yr), 1),
+                                       self.xr.astype(dtype).reshape(1, len(self.xr))))
 
-        # tthmatrix1 = np.zeros((self.ydimension, self.xdimension), dtype=float)
-        tthmatrix1 = np.zeros((len(self.yr), len(self.xr)), dtype=float)
-        tthmatrix1 += ((-self.xr + sourcexr) * sourcexr).reshape(1, len(self.xr))
-        tthmatrix1 += ((-self.yr + sourceyr) * sourceyr).reshape(len(self.yr), 1)
-        tthmatrix1 += sourcezr * sourcezr
-        tthmatrix = np.arccos(tthmatrix1 / self.dmatrix / self.distance)
-        self.tthmatrix = tthmatrix
-        Q = 4 * np.pi * np.sin(tthmatrix / 2.0) / self.wavelength
-        return Q
+    # geometry matrices, calculated when they are first accessed
+    dmatrix = property(genDistanceMatrix, doc='distance between source and each pixel')
+    tthmatrix = property(genTTHMatrix, doc='two theta angle (in radians) of each pixel')
+    qmatrix = property(genQMatrix, doc='q value of each pixel')
+    azimuthmatrix = property(genAzimuthMatrix, doc='azimuthal angle (in radians) of each pixel')
+    tthorqmatrix = property(lambda self: self.genTTHMatrix() if self.integrationspace == 'twotheta'
+                            else self.genQMatrix(), doc='tth or q value of each pixel')
 
     def genCorrectionMatrix(self):
         '''
         generate correction matrix. multiple the 2D raw counts array by this correction matrix
         to get corrected raw counts. It will calculate solid angle correction or polarization correction.
         
-        :return: 2d array, correction matrix to apply on the image
+        :return: 2d array, correction matrix to apply on the image, float32 in lean memory mode
         '''
-        rv = self._solidAngleCorrection() * self._polarizationCorrection()
+        rv = self._solidAngleCorrection()
+        rv *= self._polarizationCorrection()
+        if self.leanmemory:
+            rv = rv.astype(np.float32)
         return rv
 
     def _solidAngleCorrection(self):
@@ -293,7 +1214,7 @@ class Calculate(object):
         :return: 2d array, correction matrix to apply on the image
         '''
         if self.sacorrectionenable:
-            sourcezr = self.distance * np.cos(self.tilt)
+            sourcezr = self._getSource()[2]
             correction = (self.dmatrix / sourcezr)
         else:
             correction = np.ones((len(self.yr), len(self.xr)))
@@ -307,12 +1228,23 @@ class Calculate(object):
         :return: 2d array, correction matrix to apply on the image
         '''
         if self.polcorrectionenable:
-            # tthmatrix = self.tthorqmatrix if self.integrationspace == 'twotheta' else self.genTTHMatrix()
             tthmatrix = self.tthmatrix
-            azimuthmatrix = self.azimuthmatrix
-            p = 0.5 * (1 + (np.cos(tthmatrix)) ** 2)
-            p1 = 0.5 * self.polcorrectf * np.cos(2 * azimuthmatrix) * (np.sin(tthmatrix)) ** 2
-            p = 1.0 / (p - p1)
+            # p = 0.5 * (1 + cos(tth) ** 2), calculated in place
+            p = np.cos(tthmatrix)
+            p **= 2
+            p += 1
+            p *= 0.5
+            # p1 = 0.5 * polcorrectf * cos(2 * azimuth) * sin(tth) ** 2
+            p1 = 2 * self.azimuthmatrix
+            np.cos(p1, out=p1)
+            p1 *= 0.5 * self.polcorrectf
+            sin2 = np.sin(tthmatrix)
+            sin2 **= 2
+            p1 *= sin2
+            del sin2
+            # p = 1.0 / (p - p1)
+            p -= p1
+            np.divide(1.0, p, out=p)
         else:
             # p = np.ones((self.ydimension, self.xdimension))
             p = np.ones((len(self.yr), len(self.xr)))
@@ -18,6 +18,8 @@ import numpy as np
 import os
 import fnmatch
 import sys
+import collections
+from multiprocessing.pool import ThreadPool
 from diffpy.srxplanar.srxplanarconfig import _configPropertyR
 from tifffile import imsave as saveImage
 
@@ -48,9 +50,14 @@ class LoadImage(object):
     excludepattern = _configPropertyR('excludepattern')
     fliphorizontal = _configPropertyR('fliphorizontal')
     flipvertical = _configPropertyR('flipvertical')
+    prefetchdepth = _configPropertyR('prefetchdepth')
+    prefetchmemory = _configPropertyR('prefetchmemory')
+    watchinterval = _configPropertyR('watchinterval')
 
     def __init__(self, p):
         self.config = p
+        # image of the file currently yielded by self.iterPrefetch, (filename, AsyncResult) or None
+        self.prefetched = None
         return
 
     def flipImage(self, pic):
@@ -70,7 +77,22 @@ class LoadImage(object):
     def loadImage(self, filename):
         '''
         load image file, if failed (for example loading an incomplete file),
-        then it will keep trying loading file for 5s
+        then it will keep trying loading file for 5s. If the file is prefetched 
+        (see self.iterPrefetch), return the prefetched image.
+
+        :param filename: str, image file name
+
+        :return: 2d ndarray, 2d image array (flipped)
+        '''
+        if (self.prefetched is not None) and (self.prefetched[0] == filename):
+            result = self.prefetched[1]
+            self.prefetched = None
+            return result.get()
+        return self._loadImage(filename)
+
+    def _loadImage(self, filename):
+        '''
+        load image file, see self.loadImage
 
         :param filename: str, image file name
 
@@ -97,6 +119,109 @@ class LoadImage(object):
             image[image < 0] = 0
         return image
 
+    def loadGainMap(self, filename):
+        '''
+        load the gain map of detector, .npy file should be already flipped (same as the 
+        mask file), other image files are flipped as the images
+        
+        :param filename: str, gain map file name
+        
+        :return: 2d array, gain of each pixel
+        '''
+        if filename.endswith('.npy'):
+            rv = np.load(filename)
+        else:
+            rv = self.flipImage(openImage(filename))
+        return rv.astype(float)
+
+    def iterPrefetch(self, filelist, depth=None, maxmemory=None):
+        '''
+        iterate over filelist while the following files are loaded in background 
+        threads, so that the file I/O is overlapped with the processing of current file.
+        self.loadImage returns the prefetched image of the yielded file. The prefetched 
+        image of a file is dropped when next file is yielded. The loads are kept in the 
+        order of filelist, so a file could appear more than once.
+
+        :param filelist: list or iterable of str, image files, other items (e.g. 2d arrays)
+            are yielded without prefetching
+        :param depth: int, number of files loaded ahead, if None, use self.prefetchdepth, 
+            0 to disable prefetching
+        :param maxmemory: float, memory limit of prefetched images in MB, if None, use 
+            self.prefetchmemory, the size of each image is estimated as float64 array
+
+        :return: generator, yields items of filelist in order
+        '''
+        depth = self.prefetchdepth if depth is None else depth
+        maxmemory = self.prefetchmemory if maxmemory is None else maxmemory
+        imagesize = self.xdimension * self.ydimension * 8
+        depth = min(depth, int(maxmemory * 2 ** 20 / imagesize))
+        if depth < 1:
+            for filename in filelist:
+                yield filename
+            return
+        
+        pool = ThreadPool(depth)
+        # (filename, AsyncResult or None) in the order of filelist
+        pending = collections.deque()
+        try:
+            for filename in filelist:
+                result = None
+                if isinstance(filename, (str, unicode)):
+                    result = pool.apply_async(self._loadImage, (filename,))
+                pending.append((filename, result))
+                if len(pending) > depth:
+                    yield self._popPrefetch(pending)
+            while len(pending) > 0:
+                yield self._popPrefetch(pending)
+        finally:
+            self.prefetched = None
+            pool.terminate()
+            pool.join()
+        return
+
+    def _popPrefetch(self, pending):
+        '''
+        pop the next file to yield in self.iterPrefetch, its prefetched image replaces 
+        the one of last yielded file (dropped if it is not used)
+        '''
+        filename, result = pending.popleft()
+        self.prefetched = None if result is None else (filename, result)
+        return filename
+
+    def iterWatch(self, interval=None, existing=True):
+        '''
+        watch the self.opendirectory and yield the files match the filenames/includepattern/
+        excludepattern once they are completely written, i.e. their size and modification 
+        time are unchanged in two successive polls. The files are not read in checking.
+        It runs until the generator is closed.
+
+        :param interval: float, polling interval in seconds, if None, use self.watchinterval
+        :param existing: bool, if True, the files already in directory are also yielded
+
+        :return: generator, yields full path of files in the order they are completed 
+            (sorted by name if completed in same poll)
+        '''
+        interval = self.watchinterval if interval is None else interval
+        done = set() if existing else self.genFileSet(fullpath=True)
+        previous = {}
+        while True:
+            current = {}
+            for filename in self.genFileSet(fullpath=True) - done:
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    # removed after listing
+                    continue
+                current[filename] = (st.st_size, st.st_mtime)
+            ready = [filename for filename in sorted(current.keys())
+                     if current[filename][0] > 0 and previous.get(filename) == current[filename]]
+            done.update(ready)
+            previous = current
+            for filename in ready:
+                yield filename
+            time.sleep(interval)
+        return
+
     def genFileList(self, filenames=None, opendir=None, includepattern=None, excludepattern=None, fullpath=False):
         '''
         generate the list of file in opendir according to include/exclude pattern
@@ -33,6 +33,7 @@ except:
 import scipy.ndimage.filters as snf
 import scipy.ndimage.morphology as snm
 import os
+from multiprocessing.pool import ThreadPool
 from diffpy.srxplanar.srxplanarconfig import _configPropertyR
 
 class Mask(object):
@@ -54,12 +55,15 @@ class Mask(object):
     darkpixelmask = _configPropertyR('darkpixelmask')
     cropedges = _configPropertyR('cropedges')
     avgmask = _configPropertyR('avgmask')
+    pixelmaskmode = _configPropertyR('pixelmaskmode')
+    nthreads = _configPropertyR('nthreads')
     
     def __init__(self, p, calculate):
         self.config = p
-        self.staticmask = np.zeros((self.ydimension, self.xdimension))
+        self.staticmask = None
         self.dynamicmask = None
         self.calculate = calculate
+        self.threadpool = None
         return
 
     def staticMask(self, maskfile=None):
@@ -81,7 +85,7 @@ class Mask(object):
                 immask = openImage(maskfile)
                 rv = self.flipImage(immask)
         else:
-            rv = np.zeros((self.ydimension, self.xdimension))
+            rv = np.zeros((self.ydimension, self.xdimension), dtype=bool)
 
         self.staticmask = (rv > 0)
         return self.staticmask
@@ -91,7 +95,7 @@ class Mask(object):
         create a dynamic mask according to image array. This mask changes for different images
         
         :param pic: 2d array, image array to be processed
-        :parma dymask: 2d array, mask array used in average mask calculation
+        :parma dymask: 2d array, extra mask array used in average mask calculation
         :param brightpixelmask: pixels with much lower intensity compare to adjacent pixels will be masked
         :param darkpixelmask: pixels with much higher intensity compare to adjacent pixels will be masked
         :param avgmask: Mask the pixels too bright or too dark compared to the average intensity at the similar diffraction angle
@@ -136,27 +140,25 @@ class Mask(object):
         :param image: 2d array, image file (array)
         :param high: float (default: 2.0), int > avgint * high will be masked
         :param low: float (default: 0.5), int < avgint * low will be masked
-        :param dymask: 2d bool array, mask array used in calculation, True for masked pixel, 
-            if None, then use self.staticmask
+        :param dymask: 2d bool array, extra mask array used in calculation (in addition to 
+            the static mask already set in self.calculate), True for masked pixel
         :param cropedges: crop the image, maske pixels around the image edge (left, right, 
             top, bottom), must larger than 0, if None, use self.config.corpedges
         
-        :return 2d bool array, True for masked pixel, edgemake included, dymask not included
+        :return 2d bool array, True for masked pixel, edgemake included, dymask not included. 
+            Only the active pixels (see Calculate.getActiveInds) are tested, other pixels 
+            in the cropped image are never integrated
         '''
-        if dymask == None:
-            dymask = self.staticmask
         high = self.config.avgmaskhigh if high == None else high
         low = self.config.avgmasklow if low == None else low
         
-        self.calculate.genIntegrationInds(dymask)
+        self.calculate.setDynamicMask(dymask)
         chi = self.calculate.intensity(image)
-        index = np.rint(self.calculate.tthorqmatrix / self.config.tthorqstep).astype(int)
-        index[index >= len(chi[1]) - 1] = len(chi[1]) - 1
-        avgimage = chi[1][index.ravel()].reshape(index.shape)
-        mask = np.ones((self.ydimension, self.xdimension), dtype=bool)
-        ce = self.cropedges if cropedges == None else cropedges
-        mask[ce[2]:-ce[3], ce[0]:-ce[1]] = np.logical_or(image[ce[2]:-ce[3], ce[0]:-ce[1]] < avgimage * low,
-                                                        image[ce[2]:-ce[3], ce[0]:-ce[1]] > avgimage * high)
+        activeinds, activebins = self.calculate.getActiveInds()
+        avgvalues = chi[1][activebins]
+        values = image.ravel().take(activeinds)
+        mask = self.edgeMask(cropedges)
+        mask.ravel()[activeinds] = np.logical_or(values < avgvalues * low, values > avgvalues * high)
         return mask
 
     def darkPixelMask(self, pic, r=None):
@@ -171,11 +173,17 @@ class Mask(object):
         r = self.config.darkpixelr if r == None else r  # 0.1
         
         avgpic = np.average(pic)
-        ks = np.ones((5, 5))
-        ks1 = np.ones((7, 7))
-        picb = snf.percentile_filter(pic, 5, 3) < avgpic * r
-        picb = snm.binary_dilation(picb, structure=ks)
-        picb = snm.binary_erosion(picb, structure=ks1)
+        if self.pixelmaskmode == 'fast':
+            # 5 percentile of 3x3 window is its minimum
+            picb = snf.minimum_filter(pic, 3) < avgpic * r
+            picb = self._squareMorphology(picb, 5, np.logical_or)
+            picb = self._squareMorphology(picb, 7, np.logical_and)
+        else:
+            ks = np.ones((5, 5))
+            ks1 = np.ones((7, 7))
+            picb = snf.percentile_filter(pic, 5, 3) < avgpic * r
+            picb = snm.binary_dilation(picb, structure=ks)
+            picb = snm.binary_erosion(picb, structure=ks1)
         return picb
 
     def brightPixelMask(self, pic, size=None, r=None):
@@ -198,10 +206,89 @@ class Mask(object):
         size = self.config.brightpixelsize if size == None else size  # 5
         r = self.config.brightpixelr if r == None else r  # 1.2
         
-        rank = snf.rank_filter(pic, -size, size)
-        ind = snm.binary_dilation(pic > rank * r, np.ones((3, 3)))
+        if self.pixelmaskmode == 'fast':
+            ind = self._brightPixels(pic, size, r)
+            ind = self._squareMorphology(ind, 3, np.logical_or)
+        else:
+            rank = snf.rank_filter(pic, -size, size)
+            ind = snm.binary_dilation(pic > rank * r, np.ones((3, 3)))
         return ind
 
+    def _brightPixels(self, pic, size, r, tilerows=32):
+        '''
+        pixels brighter than r times the size-th largest value in their size x size 
+        neighborhood, same as (pic > snf.rank_filter(pic, -size, size) * r) but without 
+        ranking: a pixel is brighter than r times the k-th smallest value of its 
+        neighborhood if and only if at least k neighbors (itself included) have 
+        (value * r < pixel value). The neighbors are counted by comparing shifted views 
+        of the image, in tiles of rows processed by self.nthreads threads.
+        
+        :param pic: 2d array, image array to be processed
+        :param size: int, size of local testing area
+        :param r: float, a threshold for masked pixels
+        :param tilerows: int, number of rows in each tile
+        
+        :return: 2d array of boolean, True for pixels brighter than their neighbors
+        '''
+        ny, nx = pic.shape
+        before = size // 2
+        after = size - 1 - before
+        # 'symmetric' padding is the 'reflect' mode of scipy.ndimage
+        scaled = np.pad(pic * r, ((before, after), (before, after)), mode='symmetric')
+        need = size * size - size + 1
+        counttype = np.uint8 if size * size < 256 else np.uint16
+        rv = np.empty((ny, nx), dtype=bool)
+        
+        def countTile(lo):
+            hi = min(lo + tilerows, ny)
+            target = pic[lo:hi]
+            count = np.zeros((hi - lo, nx), dtype=counttype)
+            less = np.empty((hi - lo, nx), dtype=bool)
+            for dy in range(size):
+                for dx in range(size):
+                    np.less(scaled[lo + dy:hi + dy, dx:dx + nx], target, out=less)
+                    count += less
+            rv[lo:hi] = count >= need
+            return
+        
+        tiles = range(0, ny, tilerows)
+        if self.nthreads > 1:
+            if (self.threadpool is None) or (self.threadpoolsize != self.nthreads):
+                if self.threadpool is not None:
+                    self.threadpool.terminate()
+                    self.threadpool.join()
+                self.threadpool = ThreadPool(self.nthreads)
+                self.threadpoolsize = self.nthreads
+            self.threadpool.map(countTile, tiles)
+        else:
+            map(countTile, tiles)
+        return rv
+
+    def _squareMorphology(self, mask, size, op):
+        '''
+        binary dilation (op=np.logical_or) or erosion (op=np.logical_and) of mask by a 
+        size x size square structure, same as snm.binary_dilation/binary_erosion with 
+        np.ones((size, size)), i.e. pixels outside the image are False. The square is 
+        separable, so mask is reduced over size shifted columns then size shifted rows.
+        
+        :param mask: 2d bool array
+        :param size: int, size of square structure
+        :param op: np.logical_or or np.logical_and
+        
+        :return: 2d bool array
+        '''
+        ny, nx = mask.shape
+        before = size // 2
+        padded = np.zeros((ny + size - 1, nx + size - 1), dtype=bool)
+        padded[before:before + ny, before:before + nx] = mask
+        cols = padded[:, :nx].copy()
+        for d in range(1, size):
+            op(cols, padded[:, d:d + nx], out=cols)
+        rv = cols[:ny].copy()
+        for d in range(1, size):
+            op(rv, cols[d:d + ny], out=rv)
+        return rv
+
     def undersample(self, undersamplerate):
         '''
         a special mask used for undesampling image. It will create a mask that
@@ -15,8 +15,12 @@
 
 import numpy as np
 import scipy.io
-import os
+import os, sys
+import threading
+import Queue
+import atexit
 from diffpy.srxplanar.srxplanarconfig import _configPropertyR
+from tifffile import imsave as saveImage
 
 class SaveResults(object):
     '''
@@ -26,15 +30,109 @@ class SaveResults(object):
     savedirectory = _configPropertyR('savedirectory')
     gsasoutput = _configPropertyR('gsasoutput')
     filenameplus = _configPropertyR('filenameplus')
+    asyncwrite = _configPropertyR('asyncwrite')
 
     def __init__(self, p):
         self.config = p
+        self.writer = None
+        self.writeerror = None
+        self.atexitregistered = False
         self.prepareCalculation()
         return
 
     def prepareCalculation(self):
         if not os.path.exists(self.savedirectory):
                 os.makedirs(self.savedirectory)
+        self.header = None
+        return
+
+    def getHeader(self):
+        '''
+        get the header written to output files, it is cached until self.prepareCalculation is called
+        
+        :return: str, header including the '#### start data' line
+        '''
+        if self.header is None:
+            self.header = self.config.getHeader(mode='short') + '#### start data\n'
+        return self.header
+
+    def _write(self, func, *args):
+        '''
+        write a file by calling func(*args), if self.asyncwrite, the call is queued and 
+        executed in a background writer thread. The writer thread is a daemon thread, 
+        self.close is registered with atexit so that the queued files are written even if 
+        self.close is not called
+        
+        :param func: function which writes the file
+        :param args: arguments passed to func, should not be changed after this call
+        '''
+        if self.asyncwrite:
+            self._raiseWriteError()
+            if self.writer is None:
+                self.writequeue = Queue.Queue(256)
+                self.writer = threading.Thread(target=self._writerLoop, args=(self.writequeue,))
+                self.writer.daemon = True
+                self.writer.start()
+                if not self.atexitregistered:
+                    atexit.register(self.close)
+                    self.atexitregistered = True
+            self.writequeue.put((func, args))
+        else:
+            func(*args)
+        return
+
+    def _writerLoop(self, queue):
+        '''
+        loop of the background writer thread, runs the queued writes in order until 
+        None is received. After an error, the remaining writes are skipped and the error 
+        is re-raised by next self.flush or self.close
+        '''
+        while True:
+            job = queue.get()
+            try:
+                if job is None:
+                    return
+                if self.writeerror is None:
+                    func, args = job
+                    func(*args)
+            except:
+                self.writeerror = sys.exc_info()
+            finally:
+                queue.task_done()
+
+    def _raiseWriteError(self):
+        '''
+        re-raise the error in background writer thread
+        '''
+        if self.writeerror is not None:
+            excinfo = self.writeerror
+            self.writeerror = None
+            raise excinfo[0], excinfo[1], excinfo[2]
+        return
+
+    def flush(self):
+        '''
+        wait until all queued files are written, error in writing is re-raised here
+        
+        :return: None
+        '''
+        if self.writer is not None:
+            self.writequeue.join()
+        self._raiseWriteError()
+        return
+
+    def close(self):
+        '''
+        write all queued files and stop the background writer thread (joined here), 
+        error in writing is re-raised here
+        
+        :return: None
+        '''
+        if self.writer is not None:
+            self.writequeue.put(None)
+            self.writer.join()
+            self.writer = None
+        self._raiseWriteError()
         return
 
     def getFilePathWithoutExt(self, filename):
@@ -60,7 +158,10 @@ class SaveResults(object):
         :param rv: dict, result include integrated diffration intensity
             the rv['chi'] should be a 2d array with shape (2,len of intensity) or (3, len of intensity)
             file name is generated according to orginal file name and savedirectory
+            if rv['sectorchi'] presents, intensity of each sector is also saved in .chi
         '''
+        if rv.has_key('sectorchi'):
+            self.saveSectors(rv['sectorchi'], rv['filename'])
         rv = self.saveChi(rv['chi'], rv['filename'])
         if self.gsasoutput:
             if self.gsasoutput in set(['std', 'esd', 'fxye']):
@@ -75,11 +176,31 @@ class SaveResults(object):
         :param filename: str, base file name 
         '''
         filepath = self.getFilePathWithoutExt(filename) + '.chi'
-        f = open(filepath, 'wb')
-        f.write(self.config.getHeader(mode='short'))
-        f.write('#### start data\n')
-        np.savetxt(f, xrd.transpose(), fmt='%g')
-        f.close()
+        self._write(_writeChi, filepath, self.getHeader(), xrd)
+        return filepath
+
+    def saveSectors(self, sectorchi, filename):
+        '''
+        save diffraction intensity of each sector in .chi, '_sectorxx' is appended to the file name
+        
+        :param sectorchi: 3d array with shape (number of sectors, 2 or 3, len of intensity)
+        :param filename: str, base file name 
+        
+        :return: list of str, path of saved files
+        '''
+        filebase, ext = os.path.splitext(filename)
+        rv = [self.saveChi(xrd, '%s_sector%02d%s' % (filebase, i, ext)) for i, xrd in enumerate(sectorchi)]
+        return rv
+
+    def saveCake(self, cake, filename):
+        '''
+        save 2D caking result in .tif, rows are azimuthal bins and columns are tth or q bins
+        
+        :param cake: 2d array, caked intensity, shape is (number of azimuthal bins, number of bins)
+        :param filename: str, base file name
+        '''
+        filepath = self.getFilePathWithoutExt(filename) + '_cake.tif'
+        self._write(saveImage, filepath, cake.astype(np.float32))
         return filepath
 
     def saveGSAS(self, xrd, filename):
@@ -101,6 +222,22 @@ class SaveResults(object):
         f.close()
         return filepath
 
+def _writeChi(filepath, header, xrd):
+    '''
+    write header and diffraction intensity to .chi file
+    
+    :param filepath: str, path of file
+    :param header: str, header of file
+    :param xrd: 2d array, [tthorq, intensity, (unceratinty)]
+    '''
+    f = open(filepath, 'wb')
+    try:
+        f.write(header)
+        np.savetxt(f, xrd.transpose(), fmt='%g')
+    finally:
+        f.close()
+    return
+
 def writeGSASStr(name, mode, tth, iobs, esd=None):
     """
     Return string of integrated intensities in GSAS format.
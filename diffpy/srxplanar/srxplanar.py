@@ -20,7 +20,14 @@ srxplanar main modular
 import numpy as np
 import scipy.sparse as ssp
 import os, sys
-# import time
+import multiprocessing
+import tempfile
+import shutil
+import threading
+import Queue
+import collections
+import hashlib
+import time
 
 from diffpy.srxplanar.srxplanarconfig import SrXplanarConfig
 from diffpy.srxplanar.calculate import Calculate
@@ -33,7 +40,7 @@ class SrXplanar(object):
     main modular for srxplanar
     '''
 
-    def __init__(self, srxplanarconfig=None, configfile=None, args=None, **kwargs):
+    def __init__(self, srxplanarconfig=None, configfile=None, args=None, state=None, **kwargs):
         '''
         init srxplanar form a SrXplanarConfig instance, or config file, or args passed from cmd
         or kwargs. If both SrXplanarConfig instance and other configfile/args/kwargs is specified, 
@@ -42,6 +49,8 @@ class SrXplanar(object):
         :param srxplanarconfig: SrXplanarConfig, init srxplanar from a config instance
         :param configfile: string, name of config file
         :param args: list of str, usually be sys.argv
+        :param state: dict, prepared arrays returned by self.getState (or loadState), if provided, 
+            use them instead of running the prepare calculation
         :param kwargs: you can use like 'xbeamcenter=1024' or a dict to update the value of xbeamcenter
         '''
         if srxplanarconfig != None:
@@ -49,16 +58,34 @@ class SrXplanar(object):
             self.config.updateConfig(filename=configfile, args=args, **kwargs)
         else:
             self.config = SrXplanarConfig(filename=configfile, args=args, **kwargs)
+        # in-memory cache of prepared arrays, key -> state, in order of last use
+        self.statecache = collections.OrderedDict()
+        # values of options used in preparing each group of arrays, see self.prepareCalculation
+        self.preparedvalues = {}
+        self.staticmask = None
+        self.pixelgain = None
+        self.piccorrected = False
+        key = None
+        if state is None:
+            key, state = self._loadCachedState()
         # init modulars
         self.loadimage = LoadImage(self.config)
-        self.calculate = Calculate(self.config)
+        self.calculate = Calculate(self.config, prepare=state is None)
         self.mask = Mask(self.config, self.calculate)
         self.saveresults = SaveResults(self.config)
+        if state is not None:
+            self.setState(state)
+        else:
+            # geometry and bins are already prepared in self.calculate
+            values = self._getStageValues()
+            self.preparedvalues = {'geometry': values['geometry'], 'bins': values['bins']}
+        self.statekey = key
         return
 
     def updateConfig(self, filename=None, args=None, **kwargs):
         '''
-        update config using configfile/args/kwargs, then rerun all prepareCalculation()
+        update config using configfile/args/kwargs, then rerun prepareCalculation(), only
+        the arrays depending on the changed options are recalculated
         
         :param configfile: string, name of config file
         :param args: list of str, usually be sys.argv
@@ -68,7 +95,8 @@ class SrXplanar(object):
         '''
         self.config.updateConfig(filename=filename, args=args, **kwargs)
         # update instances
-        self.calculate.prepareCalculation()
+        self.calculate.resetGain()
+        self.prepareCalculation()
         self.saveresults.prepareCalculation()
         return
 
@@ -79,14 +107,311 @@ class SrXplanar(object):
         :param pic: str, list of str, or 2d array, if provided, and automask is True, then 
             generate a dynamic mask
         
+        The prepared arrays are grouped by the options they depend on (see _getStageValues), 
+        only the groups whose options are changed since last call are recalculated.
+        In lean memory mode, the arrays only used in preparing are dropped at the end.
+        If the cache is enabled (self.config.statecachenumber > 0 or self.config.cachedirectory 
+        is set), the prepared arrays are restored from the in-memory cache or the cache directory
+        (memory-mapped) if available, otherwise they are added to the cache.
+        
+        :return: None
+        '''
+        self._checkVarianceConfig()
+        if self._restoreCachedState():
+            return
+        values = self._getStageValues()
+        changed = set([stage for stage in values if self.preparedvalues.get(stage) != values[stage]])
+        if len(changed) == 0:
+            return
+        if 'geometry' in changed:
+            self.calculate.prepareGeometry()
+        if changed & set(['geometry', 'bins']):
+            self.calculate.genTTHorQMatrix()
+        if changed & set(['geometry', 'correction']):
+            self.correction = self.calculate.genCorrectionMatrix()
+            self.calculate.resetGain()
+        if changed & set(['geometry', 'variance']):
+            self.pixelgain = self._genPixelGain()
+        if changed & set(['geometry', 'correction', 'variance']):
+            self.calculate.setPixelGain(self.pixelgain, self.correction)
+        if changed & set(['geometry', 'bins', 'mask']):
+            if ('mask' in changed) or (self.staticmask is None):
+                self.staticmask = np.logical_or(self.mask.edgeMask(), self.mask.staticMask())
+            self.calculate.genIntegrationInds(self.staticmask)
+        self.preparedvalues = values
+        if self.config.leanmemory:
+            self._dropIntermediates()
+        self._saveCachedState()
+        return
+
+    def _checkVarianceConfig(self):
+        '''
+        check the options of variance model, the gainmapfile should be a readable file 
+        in gainmap variance model
+        
+        :return: None
+        '''
+        if self.config.variancemodel != 'gainmap':
+            return
+        filename = self.config.gainmapfile
+        if not filename:
+            raise ValueError("gainmapfile is required when variancemodel is 'gainmap'")
+        if not (os.path.isfile(filename) and os.access(filename, os.R_OK)):
+            raise ValueError("gainmapfile '%s' is not a readable file (variancemodel is 'gainmap')" % filename)
+        return
+
+    def _genPixelGain(self):
+        '''
+        load the gain of each pixel in the image cropped by cropedges, used in gainmap 
+        variance model
+        
+        :return: 2d array or None, None if variance model is not gainmap
+        '''
+        if self.config.variancemodel != 'gainmap':
+            return None
+        filename = self.config.gainmapfile
+        try:
+            gainmap = self.loadimage.loadGainMap(filename)
+        except Exception as e:
+            raise ValueError("cannot read gainmapfile '%s': %s" % (filename, e))
+        shape = (self.config.ydimension, self.config.xdimension)
+        if gainmap.shape != shape:
+            raise ValueError("gainmapfile '%s' has shape %s, the image shape is %s" % (filename, gainmap.shape, shape))
+        ce = self.config.cropedges
+        rv = gainmap[ce[2]:-ce[3], ce[0]:-ce[1]]
+        return np.array(rv, dtype=np.float32 if self.config.leanmemory else float)
+
+    def _dropIntermediates(self):
+        '''
+        release the arrays only used in preparing (static mask, geometry matrices, bin index 
+        of each pixel), used in lean memory mode. They are recalculated if needed.
+        
+        :return: None
+        '''
+        self.staticmask = None
+        self.mask.staticmask = None
+        self.calculate.dropIntermediates()
+        return
+
+    def _getStageValues(self):
+        '''
+        get the values of options each group (stage) of prepared arrays depends on, 
+        'geometry': pixel positions, distance and tth matrix, 
+        'bins': tth or q bin of each pixel, 
+        'correction': correction matrix, 
+        'mask': static mask (the size and modification time of mask file included), 
+        'variance': gain of each pixel (the size and modification time of gain map file included). 
+        The bins, correction and variance also depend on the geometry.
+        
+        :return: dict, stage name -> list of values
+        '''
+        getvalues = lambda names: [getattr(self.config, name) for name in names]
+        
+        def getfilevalues(names, filename):
+            rv = getvalues(names)
+            if os.path.exists(filename):
+                st = os.stat(filename)
+                rv.append((os.path.abspath(filename), st.st_size, st.st_mtime))
+            return rv
+        
+        rv = {'geometry': getvalues(_geometryoptions),
+              'bins': getvalues(_binoptions[self.config.integrationspace]),
+              'correction': getvalues(_correctionoptions),
+              'mask': getfilevalues(_maskoptions, self.config.maskfile),
+              'variance': getfilevalues(_varianceoptions, self.config.gainmapfile)}
+        return rv
+
+    def getStateKey(self):
+        '''
+        return the key of prepared arrays, i.e. the sha1 hash of the values of options they 
+        depend on (see self._getStageValues), including the size and modification time of the 
+        mask file
+        
+        :return: str, hex digest of the hash
+        '''
+        values = [_stateversion] + sorted(self._getStageValues().items())
+        return hashlib.sha1(repr(values)).hexdigest()
+
+    def _cacheEnabled(self):
+        '''
+        return True if the in-memory cache or the cache directory is enabled
+        '''
+        return (self.config.statecachenumber > 0) or bool(self.config.cachedirectory)
+
+    def _restoreCachedState(self):
+        '''
+        restore the prepared arrays of current configuration from cache
+        
+        :return: bool, True if the arrays are restored or already in use
+        '''
+        if not self._cacheEnabled():
+            return False
+        key = self.getStateKey()
+        if key == self.statekey:
+            return True
+        key, state = self._loadCachedState(key)
+        if state is None:
+            return False
+        self.setState(state)
+        self.statekey = key
+        return True
+
+    def _loadCachedState(self, key=None):
+        '''
+        load the prepared arrays of current configuration from the in-memory cache, or from 
+        self.config.cachedirectory (memory-mapped)
+        
+        :param key: str, key of the arrays, if None, use self.getStateKey()
+        
+        :return: [key, state], state is a dict of name and array, [None, None] if cache is 
+            disabled or the arrays are not found
+        '''
+        if not self._cacheEnabled():
+            return None, None
+        key = self.getStateKey() if key is None else key
+        state = self.statecache.pop(key, None)
+        cachedir = self.config.cachedirectory
+        if (state is None) and cachedir and os.path.isdir(os.path.join(cachedir, key)):
+            state = loadState(os.path.join(cachedir, key))
+            try:
+                # mark as recently used, see self._pruneCacheDirectory
+                os.utime(os.path.join(cachedir, key), None)
+            except OSError:
+                pass
+        if state is None:
+            return None, None
+        self._addMemoryCache(key, state)
+        return key, state
+
+    def _addMemoryCache(self, key, state):
+        '''
+        add the prepared arrays to the in-memory cache as the most recently used one, the least 
+        recently used ones are dropped if there are more than self.config.statecachenumber 
+        entries or their total size is larger than self.config.statecachememory
+        
+        :param key: str, key of the arrays
+        :param state: dict, name and array
+        '''
+        if self.config.statecachenumber <= 0:
+            return
+        self.statecache[key] = state
+        maxbytes = self.config.statecachememory * 2 ** 20
+        nbytes = lambda: sum([sum([v.nbytes for v in s.values()]) for s in self.statecache.values()])
+        while (len(self.statecache) > self.config.statecachenumber) or \
+                ((len(self.statecache) > 0) and (nbytes() > maxbytes)):
+            self.statecache.popitem(last=False)
+        return
+
+    def _saveCachedState(self):
+        '''
+        add the prepared arrays to the in-memory cache and save them to self.config.cachedirectory, 
+        the arrays are written to a temporary directory first and then renamed, so that an 
+        incomplete cache entry is never loaded. The cache directory is then pruned, see 
+        self._pruneCacheDirectory
+        
+        :return: None
+        '''
+        if not self._cacheEnabled():
+            return
+        self.statekey = self.getStateKey()
+        state = self.getState()
+        self._addMemoryCache(self.statekey, state)
+        cachedir = self.config.cachedirectory
+        if cachedir:
+            if not os.path.exists(cachedir):
+                os.makedirs(cachedir)
+            path = os.path.join(cachedir, self.statekey)
+            if not os.path.isdir(path):
+                tmpdir = tempfile.mkdtemp(prefix='tmp', dir=cachedir)
+                saveState(state, tmpdir)
+                try:
+                    os.rename(tmpdir, path)
+                except OSError:
+                    # saved by another process
+                    shutil.rmtree(tmpdir, ignore_errors=True)
+            self._pruneCacheDirectory(keep=self.statekey)
+        return
+
+    def _pruneCacheDirectory(self, keep=None):
+        '''
+        remove the least recently used (by modification time of their directories) entries in 
+        self.config.cachedirectory if there are more than self.config.cachedirectorynumber entries 
+        or their total size is larger than self.config.cachedirectorysize. Temporary directories 
+        left by interrupted saves are removed if they are older than _staletmpage seconds.
+        
+        :param keep: str, key of the entry which is never removed (the one in use)
+        
         :return: None
         '''
-        self.staticmask = self.mask.staticMask()
-        self.correction = self.calculate.genCorrectionMatrix()
-        self.staticmask = np.logical_or(self.mask.edgeMask(), self.staticmask)
-        self.calculate.genIntegrationInds(self.staticmask)
+        cachedir = self.config.cachedirectory
+        now = time.time()
+        entries = []
+        for name in os.listdir(cachedir):
+            path = os.path.join(cachedir, name)
+            if not os.path.isdir(path):
+                continue
+            try:
+                mtime = os.path.getmtime(path)
+                if name.startswith('tmp'):
+                    if now - mtime > _staletmpage:
+                        shutil.rmtree(path, ignore_errors=True)
+                    continue
+                nbytes = sum([os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)])
+            except OSError:
+                # removed by another process
+                continue
+            entries.append((mtime, nbytes, name))
+        # least recently used first
+        entries.sort()
+        maxnumber = self.config.cachedirectorynumber
+        maxbytes = self.config.cachedirectorysize * 2 ** 20
+        number = len(entries)
+        total = sum([e[1] for e in entries])
+        for mtime, nbytes, name in entries:
+            if not (((maxnumber > 0) and (number > maxnumber)) or ((maxbytes > 0) and (total > maxbytes))):
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(os.path.join(cachedir, name), ignore_errors=True)
+            number -= 1
+            total -= nbytes
         return
+
+    def getState(self):
+        '''
+        return the prepared arrays, including the static mask (if not dropped in lean 
+        memory mode), correction matrix, gain of each pixel (in gainmap variance model) 
+        and the arrays returned by Calculate.getState
+        
+        :return: dict, name and array
+        '''
+        rv = self.calculate.getState()
+        if self.staticmask is not None:
+            rv['staticmask'] = self.staticmask
+        if self.pixelgain is not None:
+            rv['pixelgain'] = self.pixelgain
+        rv['correction'] = self.correction
+        return rv
+
+    def setState(self, state):
+        '''
+        restore the prepared arrays returned by self.getState, replace the self.prepareCalculation.
+        The arrays are not copied, so they could be read-only memory-mapped arrays 
         
+        :param state: dict, name and array
+        
+        :return: None
+        '''
+        self.calculate.setState(state)
+        self.staticmask = state.get('staticmask')
+        self.correction = state['correction']
+        self.pixelgain = state.get('pixelgain')
+        self.calculate.setPixelGain(self.pixelgain, self.correction)
+        self.statekey = None
+        # state is generated with current configuration
+        self.preparedvalues = self._getStageValues()
+        return
+
     def _picChanged(self, extramask=None):
         '''
         update all pic related data (such as dynamic mask) when a new image is read
@@ -95,19 +420,29 @@ class SrXplanar(object):
         
         :return: None
         '''
-        dynamicmask = self.mask.dynamicMask(self.pic, dymask=self.staticmask)
+        self.calculate.newFrame(self.pic, self.piccorrected)
+        dynamicmask = self.mask.dynamicMask(self.pic)
 
-        if dynamicmask != None:
-            mask = np.logical_or(self.staticmask, dynamicmask)
-            if extramask != None:
+        if dynamicmask is not None:
+            mask = dynamicmask
+            if extramask is not None:
                 mask = np.logical_or(mask, extramask)
-        elif extramask != None:
-            mask = np.logical_or(self.staticmask, extramask)
         else:
-            mask = self.staticmask
+            mask = extramask
 
-        if (dynamicmask != None) or (extramask != None):
-            self.calculate.genIntegrationInds(mask)
+        # static mask is already applied in self.prepareCalculation
+        self.calculate.setDynamicMask(mask)
+        return
+
+    def _dropPic(self):
+        '''
+        release the image and its dynamic mask after integration in lean memory mode
+        
+        :return: None
+        '''
+        if self.config.leanmemory:
+            self.pic = None
+            self.mask.dynamicmask = None
         return
 
     def _getSaveFileName(self, imagename=None, filename=None):
@@ -150,9 +485,11 @@ class SrXplanar(object):
             for imagefile in image:
                 rv += self._getPic(imagefile)
             rv /= len(image)
+            corrected = True
         elif isinstance(image, (str, unicode)):
             rv = self.loadimage.loadImage(image)
-            if correction == None or correction == True:
+            corrected = correction == None or correction == True
+            if corrected:
                 ce = self.config.cropedges
                 rv[ce[2]:-ce[3], ce[0]:-ce[1]] = rv[ce[2]:-ce[3], ce[0]:-ce[1]] * self.correction 
                 # rv *= self.correction
@@ -160,12 +497,15 @@ class SrXplanar(object):
             rv = image
             if flip == True:
                 rv = self.loadimage.flipImage(rv)
-            if correction == True:
+            corrected = correction == True
+            if corrected:
                 # rv *= self.correction
                 ce = self.config.cropedges
                 rv[ce[2]:-ce[3], ce[0]:-ce[1]] = rv[ce[2]:-ce[3], ce[0]:-ce[1]] * self.correction
         if rv.dtype.kind != 'f':
-            rv = rv.astype(float)
+            rv = rv.astype(np.float32 if self.config.leanmemory else float)
+        # used in the poisson and gainmap variance model
+        self.piccorrected = corrected
         return rv
 
     def integrate(self, image, savename=None, savefile=True, flip=None, correction=None, extramask=None):
@@ -186,7 +526,8 @@ class SrXplanar(object):
         
         :return: dict, rv['chi'] is a 2d array of integrated intensity, shape is (2, len of intensity) 
             or (3, len of intensity) in [tth or q, intensity, (uncertainty)]. rv['filename'] is the 
-            name of file to save to disk
+            name of file to save to disk. If sectornumber > 0, rv['sectorchi'] is a 3d array of 
+            integrated intensity of each sector, shape is (sectornumber, 2 or 3, len of intensity)
         '''
         rv = {}
         self.pic = self._getPic(image, flip, correction)
@@ -195,12 +536,98 @@ class SrXplanar(object):
         self._picChanged(extramask=extramask)
         # calculate
         rv['chi'] = self.chi = self.calculate.intensity(self.pic)
+        if self.config.sectornumber > 0:
+            rv['sectorchi'] = self.calculate.sectorIntensity(self.pic)
+        self._dropPic()
         # save
         if savefile:
             rv['filename'] = self.saveresults.save(rv)
         return rv
 
-    def integrateFilelist(self, filelist, summation=None, filename=None, flip=None, correction=None, extramask=None):
+    def integrateCake(self, image, savename=None, savefile=True, flip=None, correction=None, extramask=None):
+        '''
+        integrate 2d image to a 2d (azimuth, tth or q) cake, then save to disk
+        
+        :param image: str or 2d array, 
+            if str, then read image file using it as file name.
+            if 2d array, integrate this 2d array.
+        :param savename: str, name of file to save
+        :param savefile: boolean, if True, save file to disk, if False, do not save file to disk
+        :param flip: flip the image/2d array,
+            if None: flip on the string/list of string, not flip on the 2d array
+            Flip behavior is controlled in self.config
+        :param correction: apply correction to the returned 2d array
+            if None: correct on the string/list of string, not correct on the 2d array
+        :param extramask: 2d array, extra mask applied in integration 
+        
+        :return: dict, rv['cake'] is a 2d array of caked intensity, shape is (number of azimuthal bins, 
+            len of intensity), rv['count'] is the number of pixels in each cell, rv['uncertainty'] is the 
+            uncertainty (only if uncertaintyenable), rv['xgrid'] and rv['azimuthgrid'] are the tth or q and 
+            azimuth (in degree) grid, rv['filename'] is the name of file to save to disk
+        '''
+        rv = {}
+        self.pic = self._getPic(image, flip, correction)
+
+        rv['filename'] = self._getSaveFileName(imagename=image, filename=savename)
+        self._picChanged(extramask=extramask)
+        # calculate
+        cake, count, std = self.calculate.cake(self.pic)
+        rv['cake'] = cake
+        rv['count'] = count
+        if std is not None:
+            rv['uncertainty'] = std
+        rv['xgrid'] = self.calculate.xgrid
+        rv['azimuthgrid'] = self.calculate.azimuthgrid
+        self._dropPic()
+        # save
+        if savefile:
+            rv['filename'] = self.saveresults.saveCake(cake, rv['filename'])
+        return rv
+
+    def integrateStack(self, stack, flip=None, correction=None, extramask=None, chunksize=16):
+        '''
+        integrate a stack of 2d images to 1d diffraction patterns in a vectorized way. 
+        The static mask (and extramask) is applied to all images, dynamic masks are 
+        not generated for each image. Results are not saved to disk.
+        
+        :param stack: 3d array, stack of images with shape (number of images, ydimension, xdimension),
+            could be a np.memmap
+        :param flip: bool, if True, flip the images, Flip behavior is controlled in self.config
+        :param correction: bool, if True, apply correction to the images
+        :param extramask: 2d array, extra mask applied in integration
+        :param chunksize: int, number of images integrated together in one pass, 
+            limit the memory used by the chunk copied from the stack
+        
+        :return: dict, rv['xgrid'] is the tth or q grid, rv['intensity'] is a 2d array of 
+            integrated intensity, shape is (number of images, len of intensity), 
+            rv['uncertainty'] has same shape as rv['intensity'] (only if uncertaintyenable)
+        '''
+        self.calculate.setDynamicMask(extramask)
+        ce = self.config.cropedges
+        intensity = []
+        std = []
+        for i in range(0, len(stack), chunksize):
+            pics = np.array(stack[i:i + chunksize], dtype=np.float32 if self.config.leanmemory else float)
+            if flip == True:
+                if self.config.fliphorizontal:
+                    pics = pics[:, :, ::-1]
+                if self.config.flipvertical:
+                    pics = pics[:, ::-1, :]
+                pics = np.ascontiguousarray(pics)
+            if correction == True:
+                pics[:, ce[2]:-ce[3], ce[0]:-ce[1]] *= self.correction
+            inten, s = self.calculate.intensityStack(pics, corrected=correction == True)
+            intensity.append(inten)
+            std.append(s)
+        
+        rv = {}
+        rv['xgrid'] = self.calculate.xgrid
+        rv['intensity'] = np.vstack(intensity)
+        if self.config.uncertaintyenable:
+            rv['uncertainty'] = np.vstack(std)
+        return rv
+
+    def integrateFilelist(self, filelist, summation=None, filename=None, flip=None, correction=None, extramask=None, jobs=None):
         '''
         process all file in filelist, integrate them separately or together
         
@@ -214,12 +641,15 @@ class SrXplanar(object):
         :param correction: apply correction to the returned 2d array
             if None: correct on the string/list of string, not correct on the 2d array
         :param extramask: 2d array, extra mask applied in integration 
+        :param jobs: int or None, number of worker processes used to integrate files 
+            separately, if None, use self.config.jobs
         
         :return: list of dict, in each dict, rv['chi'] is a 2d array of integrated intensity, shape is (2, len of intensity) 
             or (3, len of intensity) as [tth or q, intensity, (uncertainty)]. rv['filename'] is the 
             name of file to save to disk
         '''
         summation = self.config.summation if summation == None else summation
+        jobs = self.config.jobs if jobs is None else jobs
         if (summation)and(len(filelist) > 1):
             image = self._getPic(filelist, flip, correction)
             if filename == None:
@@ -228,23 +658,174 @@ class SrXplanar(object):
                 else:
                     filename = 'Sum_xrd.chi'
             rv = [self.integrate(image, savename=filename, extramask=extramask)]
+            self.saveresults.flush()
         else:
-            i = 0
-            rv = []
-            for imagefile in filelist:
-                if filename == None:
-                    rvv = self.integrate(imagefile, flip=flip, correction=correction, extramask=extramask)
-                else:
-                    rvv = self.integrate(imagefile, savename=filename + '%03d' % i,
-                                         flip=flip, correction=correction, extramask=extramask)
-                rv.append(rvv)
+            jobs = jobs if len(filelist) > 1 else 1
+            rv = list(self.iterIntegrate(filelist, filename=filename, flip=flip, correction=correction,
+                                         extramask=extramask, jobs=jobs))
+        return rv
+
+    def iterIntegrate(self, filelist, filename=None, savefile=True, flip=None, correction=None,
+                      extramask=None, jobs=None, lookahead=0, prefetchdepth=None):
+        '''
+        integrate files separately and yield the results one by one in the order of filelist, 
+        so that the results could be processed as soon as they are ready and they are not 
+        kept in memory. 
+        
+        :param filelist: list or iterable of string, files to be integrated (full path), 
+            could be a generator which yields files when they are available
+        :param filename: file name of output file, if provided, the output files are named 
+            as filename + index
+        :param savefile: boolean, if True, save file to disk, if False, do not save file to disk
+        :param flip: flip the image/2d array,
+            if None: flip on the string/list of string, not flip on the 2d array
+            Flip behavior is controlled in self.config
+        :param correction: apply correction to the returned 2d array
+            if None: correct on the string/list of string, not correct on the 2d array
+        :param extramask: 2d array, extra mask applied in integration 
+        :param jobs: int or None, number of worker processes, if None, use self.config.jobs
+        :param lookahead: int, number of results computed ahead of the consumer. If jobs is 1, 
+            files are integrated in a background thread (so self should not be used by consumer 
+            before the iteration is finished), otherwise up to jobs + lookahead files are 
+            dispatched to worker processes at the same time
+        :param prefetchdepth: int or None, number of files loaded in background if jobs is 1, 
+            if None, use self.config.prefetchdepth. Should be 0 if filelist yields files 
+            when they are available
+        
+        :return: generator of dict, results of self.integrate 
+        '''
+        jobs = self.config.jobs if jobs is None else jobs
+        kwargs = {'savefile':savefile, 'flip':flip, 'correction':correction, 'extramask':extramask}
+        savename = lambda i: None if filename == None else filename + '%03d' % i
+        if jobs > 1:
+            items = ((imagefile, savename(i)) for i, imagefile in enumerate(filelist))
+            results = self._iterParallel(items, kwargs, jobs, lookahead)
+        else:
+            # next files are loaded in background while integrating current one
+            files = self.loadimage.iterPrefetch(filelist, depth=prefetchdepth)
+            results = (self.integrate(imagefile, savename=savename(i), **kwargs)
+                       for i, imagefile in enumerate(files))
+            if lookahead > 0:
+                results = _iterLookahead(results, lookahead)
+        for rv in results:
+            yield rv
+        self.saveresults.flush()
+
+    def _getWorkerState(self):
+        '''
+        return the prepared arrays used by the worker processes, i.e. self.getState without 
+        the arrays only used in preparing (bin index of each pixel, static mask). The azimuth 
+        matrix is included only if the sectors are integrated.
+        
+        :return: dict, name and array
+        '''
+        rv = self.getState()
+        rv.pop('tthorqinds', None)
+        rv.pop('staticmask', None)
+        if self.config.sectornumber <= 0:
+            rv.pop('azimuthmatrix', None)
         return rv
 
+    def _shareState(self):
+        '''
+        save the arrays used by the worker processes (see self._getWorkerState) to a temporary 
+        directory, in memory (/dev/shm) if it has enough free space, otherwise (or if saving 
+        there fails) in the default temporary directory
+        
+        :return: str, the temporary directory, should be removed by the caller
+        '''
+        state = self._getWorkerState()
+        nbytes = sum([v.nbytes for v in state.values()])
+        shmdir = '/dev/shm'
+        if os.path.isdir(shmdir) and hasattr(os, 'statvfs'):
+            st = os.statvfs(shmdir)
+            if st.f_bavail * st.f_frsize > nbytes * 1.1:
+                statedir = tempfile.mkdtemp(prefix='srxplanar', dir=shmdir)
+                try:
+                    saveState(state, statedir)
+                    return statedir
+                except (IOError, OSError):
+                    shutil.rmtree(statedir, ignore_errors=True)
+        statedir = tempfile.mkdtemp(prefix='srxplanar')
+        try:
+            saveState(state, statedir)
+        except:
+            shutil.rmtree(statedir, ignore_errors=True)
+            raise
+        return statedir
+
+    def _iterParallel(self, items, kwargs, jobs, lookahead=0):
+        '''
+        integrate files in a pool of worker processes, each worker holds a prepared
+        SrXplanar instance created from current configuration. At most jobs + lookahead 
+        files are dispatched at the same time.
+        
+        :param items: iterable of (imagefile, savename), files to be integrated and names of file to save
+        :param kwargs: dict, kwargs passed to self.integrate
+        :param jobs: int, number of worker processes
+        :param lookahead: int, number of extra files dispatched to workers
+        
+        :return: generator of dict, results of self.integrate in the order of items
+        '''
+        statedir = self._shareState() if self.config.sharestate else None
+        try:
+            pool = multiprocessing.Pool(jobs, initializer=_initWorker,
+                                        initargs=(_getConfigKwargs(self.config), kwargs, statedir))
+            try:
+                pending = collections.deque()
+                for item in items:
+                    pending.append(pool.apply_async(_integrateWorker, (item,)))
+                    if len(pending) > jobs + lookahead:
+                        yield pending.popleft().get()
+                while len(pending) > 0:
+                    yield pending.popleft().get()
+            finally:
+                # all results are collected, or error raised, or generator closed before finished
+                pool.terminate()
+                pool.join()
+        finally:
+            if statedir is not None:
+                shutil.rmtree(statedir, ignore_errors=True)
+        return
+
+    def watch(self, interval=None, existing=True):
+        '''
+        prepare the calculation once, then keep watching the opendirectory and integrate 
+        new files which match the filenames/includepattern/excludepattern once they are 
+        completely written (see LoadImage.iterWatch). It runs until interrupted (Ctrl+C). 
+        Files are integrated one by one in this process (into cakes if self.config.cake), 
+        a file which fails (e.g. unreadable or corrupted) is reported and skipped.
+        
+        :param interval: float, polling interval in seconds, if None, use self.config.watchinterval
+        :param existing: bool, if True, the files already in directory are also integrated
+        
+        :return: None
+        '''
+        self.prepareCalculation()
+        files = self.loadimage.iterWatch(interval, existing)
+        integrate = self.integrateCake if self.config.cake else self.integrate
+        try:
+            for imagefile in files:
+                try:
+                    rv = integrate(imagefile)
+                except KeyboardInterrupt:
+                    raise
+                except Exception as e:
+                    print 'Failed: %s (%s: %s)' % (imagefile, type(e).__name__, e)
+                    continue
+                print 'Integrated: %s' % rv['filename']
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.saveresults.close()
+        return
+
     def process(self):
         '''
         process the images according to filenames/includepattern/excludepattern/summation
         by default, it will scan current/tifdirectory and integrate all files match 
-        includepattern/excludepattern and/or filenames.
+        includepattern/excludepattern and/or filenames. If self.config.cake, each file is 
+        integrated into a 2D cake (see self.integrateCake).
         
         Usually this one is called from cmd line rather then script.
         
@@ -252,9 +833,21 @@ class SrXplanar(object):
         '''
         if not self.config.nocalculation:
             filelist = self.loadimage.genFileList()
-            if len(filelist) > 0:
+            if self.config.watch:
+                self.watch()
+            elif len(filelist) > 0:
                 self.prepareCalculation(pic=filelist[0])
-                self.integrateFilelist(filelist)
+                try:
+                    if self.config.summation:
+                        self.integrateFilelist(filelist)
+                    elif self.config.cake:
+                        for imagefile in filelist:
+                            self.integrateCake(imagefile)
+                    else:
+                        for rv in self.iterIntegrate(filelist):
+                            pass
+                finally:
+                    self.saveresults.close()
             else:
                 print 'No input files or configurations'
                 self.config.args.print_help()
@@ -298,6 +891,148 @@ class SrXplanar(object):
 
 
 
+# options each group of prepared arrays depends on, see SrXplanar._getStageValues
+_geometryoptions = ['xdimension', 'ydimension', 'xpixelsize', 'ypixelsize', 'xbeamcenter', 'ybeamcenter',
+                    'distance', 'rotationd', 'tiltd', 'cropedges', 'geometrydtype', 'leanmemory']
+_binoptions = {'twotheta': ['integrationspace', 'tthstepd', 'tthmaxd', 'splitpixel'],
+               'qspace': ['integrationspace', 'qstep', 'qmax', 'wavelength', 'splitpixel']}
+_correctionoptions = ['sacorrectionenable', 'polcorrectionenable', 'polcorrectf']
+_maskoptions = ['xdimension', 'ydimension', 'cropedges', 'maskfile', 'fliphorizontal', 'flipvertical']
+_varianceoptions = ['variancemodel', 'gainmapfile', 'fliphorizontal', 'flipvertical', 'leanmemory']
+# increase it when the content of prepared arrays is changed
+_stateversion = 2
+# temporary directories in cache directory older than this (in seconds) are left by interrupted saves
+_staletmpage = 3600
+
+def _getConfigKwargs(config):
+    '''
+    get the values of options in config as a dict, used to create a SrXplanar instance 
+    with same configuration in worker processes
+    
+    :param config: SrXplanarConfig
+    
+    :return: dict, name and value of options
+    '''
+    # asyncwrite is skipped, workers write files directly since the pool may be terminated
+    # right after the last result is returned
+    skip = ['configfile', 'createconfig', 'createconfigfull', 'createmask', 'filenames', 'jobs', 'asyncwrite']
+    rv = dict([(optname, getattr(config, optname)) for optname in config._optdata.keys()
+               if optname not in skip])
+    return rv
+
+def saveState(state, directory):
+    '''
+    save the prepared arrays to a directory, one .npy file for each array
+    
+    :param state: dict, name and array, returned by SrXplanar.getState
+    :param directory: str, directory to save the arrays, should exist
+    
+    :return: None
+    '''
+    for name, value in state.items():
+        np.save(os.path.join(directory, name + '.npy'), value)
+    return
+
+def loadState(directory, mmap_mode='r'):
+    '''
+    load the prepared arrays saved by saveState
+    
+    :param directory: str, directory of saved arrays
+    :param mmap_mode: str or None, passed to np.load, by default the arrays are 
+        memory-mapped in read-only mode, so they are shared between processes
+    
+    :return: dict, name and array
+    '''
+    rv = {}
+    for filename in os.listdir(directory):
+        name, ext = os.path.splitext(filename)
+        if ext == '.npy':
+            rv[name] = np.load(os.path.join(directory, filename), mmap_mode=mmap_mode)
+    return rv
+
+def _iterLookahead(results, lookahead):
+    '''
+    compute the items of an iterator in a background thread, at most lookahead items 
+    are kept in buffer. Exceptions raised in the background thread are re-raised
+    
+    :param results: iterator
+    :param lookahead: int, size of buffer
+    
+    :return: generator, yields items of results in order
+    '''
+    queue = Queue.Queue(lookahead)
+    stop = threading.Event()
+    end = object()
+    
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    
+    def produce():
+        try:
+            for rv in results:
+                if not put((rv, None)):
+                    return
+            put((end, None))
+        except:
+            put((None, sys.exc_info()))
+        return
+    
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            rv, excinfo = queue.get()
+            if excinfo is not None:
+                raise excinfo[0], excinfo[1], excinfo[2]
+            if rv is end:
+                break
+            yield rv
+    finally:
+        stop.set()
+        thread.join()
+    return
+
+# SrXplanar instance in worker process
+_worker = None
+_workerkwargs = {}
+
+def _initWorker(configkwargs, kwargs, statedir=None):
+    '''
+    initializer of worker process, create and prepare a SrXplanar instance
+    
+    :param configkwargs: dict, values of options
+    :param kwargs: dict, kwargs passed to SrXplanar.integrate
+    :param statedir: str or None, directory of arrays saved by saveState, if provided, 
+        attach to these arrays (memory-mapped) instead of preparing them
+    '''
+    global _worker, _workerkwargs
+    if statedir is not None:
+        _worker = SrXplanar(state=loadState(statedir), **configkwargs)
+    else:
+        _worker = SrXplanar(**configkwargs)
+        _worker.prepareCalculation()
+    _workerkwargs = kwargs
+    return
+
+def _integrateWorker(args):
+    '''
+    integrate one file in worker process
+    
+    :param args: (imagefile, savename)
+    
+    :return: dict, result of SrXplanar.integrate
+    '''
+    imagefile, savename = args
+    return _worker.integrate(imagefile, savename=savename, **_workerkwargs)
+
+
 def main():
     '''
     read config and integrate images
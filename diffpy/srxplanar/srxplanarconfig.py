@@ -59,6 +59,28 @@ _optdatalist = [
             'n':'?',
             'co':True,
             'd':False, }],
+        ['cake', {'sec':'Control', 'config':'n', 'header':'n',
+            'h':'integrate each image into a 2D (azimuth, tth or q) cake saved as _cake.tif (see \
+azimuthstepd) instead of the 1D pattern, files are integrated in one process, not used with summation',
+            'n':'?',
+            'co':True,
+            'd':False, }],
+        ['watch', {'sec':'Control', 'config':'n', 'header':'n',
+            'h':'keep running and integrate new files in opendirectory which match the \
+filenames/includepattern/excludepattern once they are completely written',
+            'n':'?',
+            'co':True,
+            'd':False, }],
+        ['jobs', {'sec':'Control', 'config':'n', 'header':'n',
+            's':'j',
+            'h':'number of worker processes used to integrate files in parallel',
+            'd':1, }],
+        ['sharestate', {'sec':'Control', 'header':'n',
+            'h':'share the prepared geometry and correction arrays with worker processes \
+through memory-mapped files, instead of preparing them in each worker',
+            'n':'?',
+            'co':True,
+            'd':True, }],
         # Expeiment gropu
         ['opendirectory', {'sec':'Control', 'header':'n',
             's':'opendir',
@@ -113,6 +135,16 @@ _optdatalist = [
             's':'qs',
             'h':'integration step in q space, in Angstrom^-1',
             'd':0.02, }],
+        ['azimuthstepd', {'sec':'Experiment',
+            'h':'azimuthal step of 2D caking integration (see cake), in degree',
+            'd':5.0, }],
+        ['sectornumber', {'sec':'Experiment',
+            'h':'number of azimuthal sectors, if >0, the image is also integrated into this number of \
+1D patterns, one for each sector',
+            'd':0, }],
+        ['sectoroffsetd', {'sec':'Experiment',
+            'h':'azimuthal angle of the start of the first sector, in degree',
+            'd':0.0, }],
         # Beamline group
         ['includepattern', {'sec':'Beamline', 'header':'n', 'config':'f',
             's':'ipattern',
@@ -188,6 +220,47 @@ _optdatalist = [
             'n':'?',
             'co':True,
             'd':True, }],
+        ['pixelmaskmode', {'sec':'Others',
+            'h':'implementation of darkpixelmask and brightpixelmask, rankfilter: scipy percentile/rank \
+filters and binary morphology, fast: 3x3 minimum filter for dark pixels, bright pixels found by \
+counting the dimmer neighbors over shifted views of the image in threaded tiles (see nthreads), \
+then dilation/erosion by separable square morphology, the result is exactly the same as rankfilter',
+            'd':'fast',
+            'c':['fast', 'rankfilter'], }],
+        ['variancemodel', {'sec':'Others',
+            'h':'model of the variance of each pixel used in uncertainty propagation, local: \
+estimated from the local variance of image (see gainmode), poisson: variance equals raw counts \
+(e.g. photon counting detector), gainmap: variance equals raw counts times the gain of each pixel \
+read from gainmapfile, scatter: variance of the pixel values in each bin (azimuthal scatter)',
+            'd':'local',
+            'c':['local', 'poisson', 'gainmap', 'scatter'], }],
+        ['gainmapfile', {'sec':'Others',
+            'h':'the gain map file used (and required) in gainmap variance model (support numpy .npy array, and \
+tiff image, .npy file should be already flipped as the mask file)',
+            'd':'',
+            'tt':'file'}],
+        ['gainmode', {'sec':'Others',
+            'h':'method to estimate the gain (ratio between local variance and raw counts) used in \
+uncertainty propagation, full: median over all pixels, subsample: median over every gainsubsample-th \
+row of the image',
+            'd':'full',
+            'c':['full', 'subsample'], }],
+        ['gainsubsample', {'sec':'Others',
+            'h':'row step of the subsample gain estimation',
+            'd':8, }],
+        ['gainrecompute', {'sec':'Others',
+            'h':'estimate the gain every this number of images and reuse it for the images in \
+between, 0 to estimate it only once (until the configuration is changed)',
+            'd':1, }],
+        ['gaindrift', {'sec':'Others',
+            'h':'also estimate the gain when the total counts of image differ from those of the \
+image used in last estimation by more than this relative amount, 0 to disable',
+            'd':0.0, }],
+        ['splitpixel', {'sec':'Others',
+            'h':'pixel splitting mode, none: non splitting pixel algorithm, bbox: intensity of each pixel is \
+split uniformly over the tth or q range covered by its bounding box',
+            'd':'none',
+            'c':['none', 'bbox'], }],
         ['gsasoutput', {'sec':'Others', 'header':'n',
             'h':'select if want to output gsas format file',
             'c':['None', 'std', 'esd', 'fxye'],
@@ -209,6 +282,56 @@ so change this value does not require a config update, value must larger than 0'
             'tt':'array',
             't':'intlist',
             'd':[1, 1, 1, 1], }],
+        ['geometrydtype', {'sec':'Others',
+            'h':'precision of the geometry matrices (distance, twotheta, q, azimuth) used in \
+preparing the integration, float32 halves their memory',
+            'd':'float64',
+            'c':['float64', 'float32'], }],
+        ['leanmemory', {'sec':'Others',
+            'h':'reduce the memory held by a prepared instance, the geometry matrices, bin index \
+of each pixel, static mask and image are dropped once the integration is prepared (they are \
+recalculated if needed), indices are stored as int32, correction matrix and images as float32, \
+the intensity is still summed in float64',
+            'n':'?',
+            'co':True,
+            'd':False, }],
+        ['nthreads', {'sec':'Others', 'header':'n',
+            'h':'number of threads used in integration',
+            'd':1, }],
+        ['cachedirectory', {'sec':'Others', 'header':'n',
+            'h':'directory to cache the prepared geometry, correction and mask arrays, they are \
+reused if the geometry is not changed, empty to disable the cache',
+            'd':'', }],
+        ['cachedirectorynumber', {'sec':'Others', 'header':'n',
+            'h':'number of prepared states kept in cache directory, the least recently used ones \
+are removed, 0 for no limit',
+            'd':16, }],
+        ['cachedirectorysize', {'sec':'Others', 'header':'n',
+            'h':'size limit of prepared states kept in cache directory, in MB, 0 for no limit',
+            'd':4096.0, }],
+        ['statecachenumber', {'sec':'Others', 'header':'n',
+            'h':'number of prepared geometry states kept in memory, they are reused when the geometry \
+is changed back (e.g. in calibration), 0 to disable',
+            'd':0, }],
+        ['statecachememory', {'sec':'Others', 'header':'n',
+            'h':'memory limit of prepared geometry states kept in memory, in MB',
+            'd':1024.0, }],
+        ['watchinterval', {'sec':'Others', 'header':'n',
+            'h':'polling interval of watch mode, in second',
+            'd':0.2, }],
+        ['asyncwrite', {'sec':'Others', 'header':'n',
+            'h':'write output files in a background thread, files are guaranteed to be written \
+only after the processing is finished (or SaveResults.flush/close is called), pending files \
+are written at exit otherwise',
+            'n':'?',
+            'co':True,
+            'd':False, }],
+        ['prefetchdepth', {'sec':'Others', 'header':'n',
+            'h':'number of image files loaded in background while integrating current file, 0 to disable',
+            'd':2, }],
+        ['prefetchmemory', {'sec':'Others', 'header':'n',
+            'h':'memory limit of images loaded in background, in MB',
+            'd':512.0, }],
         ['nocalculation', {'sec':'Others', 'config':'n', 'header':'n',
             'h':'set True to disable all calculation, will automaticly set True if createconfig or createmask',
             'n':'?',
@@ -257,10 +380,10 @@ class SrXplanarConfig(ConfigBase):
         
         this method will be called before reading config from file/args/kwargs
         
-        add degree/rad delegation for rotation, tilt, tthstep, tthmax
+        add degree/rad delegation for rotation, tilt, tthstep, tthmax, azimuthstep, sectoroffset
         '''
 
-        for name in ['rotation', 'tilt', 'tthstep', 'tthmax']:
+        for name in ['rotation', 'tilt', 'tthstep', 'tthmax', 'azimuthstep', 'sectoroffset']:
             setattr(self.__class__, name, _configPropertyRad(name + 'd'))
         # cls._configlist['Experiment'].extend(['rotation', 'tilt', 'tthstep', 'tthmax'])
         return